@@ -1 +1,4 @@
-from app import app
+from app import create_app
+
+# очистку токенов запускает первый обслуженный запрос, команды flask потоков не запускают
+app = create_app()
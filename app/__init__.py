@@ -1,20 +1,137 @@
-from flask import Flask
-from config import Config
-from peewee import SqliteDatabase
-# from logging.handlers import RotatingFileHandler
-from logging import FileHandler, Formatter, INFO
-
-app = Flask(__name__)
-app.config.from_object(Config)
-file_handler = FileHandler('logs/app.log')  # RotatingFileHandler
-file_handler.setFormatter(Formatter('%(asctime)s %(levelname)s: %(message)s'))
-app.logger.setLevel(INFO)
-file_handler.setLevel(INFO)
-app.logger.addHandler(file_handler)
-db = SqliteDatabase('data.db')
-
-from app import routes, models, errors
-from app.api import bp as api_bp
-app.register_blueprint(api_bp, url_prefix='/api')
-
-app.jinja_env.globals['my_global_var'] = 'my_global_var`s_value'
+import peewee as pw
+from flask import Flask, current_app, has_app_context
+from werkzeug.local import LocalProxy
+from app.cache import TokenCache, make_response_cache
+from app.default_config import DefaultConfig
+from app.log import setup_logging
+from app.metrics import Metrics
+from app.routing import RoutedSqliteDatabase, RoutedPooledSqliteDatabase
+from app import hashing
+
+
+class AppDatabaseProxy(pw.DatabaseProxy):
+    """ База текущего приложения (app.extensions['database']).
+
+    Вне контекста приложения - база, заданная initialize (для скриптов).
+    Поэтому у нескольких приложений в одном процессе базы не смешиваются.
+    """
+
+    __slots__ = ('default',)
+
+    @property
+    def obj(self):
+        if has_app_context():
+            database = current_app.extensions.get('database')
+            if database is not None:
+                return database
+        return self.default
+
+    @obj.setter
+    def obj(self, value):
+        self.default = value
+
+    def __setattr__(self, attr, value):
+        object.__setattr__(self, attr, value)
+
+
+# Состояние приложений хранится в app.extensions, модули обращаются к нему через
+# эти объекты: импорт пакета не открывает файлов и соединений и не запускает потоков.
+db = AppDatabaseProxy()
+# вне контекста приложения токены не кэшируются
+disabled_token_cache = TokenCache(maxsize=0)
+token_cache = LocalProxy(lambda: current_app.extensions['token_cache'] if has_app_context()
+                         else disabled_token_cache)
+
+
+def make_database(config):
+    """ База по DATABASE_*: пул соединений, если задан DATABASE_MAX_CONNECTIONS,
+    и чтение через соединения только для чтения, если задан DATABASE_READ_CONNECTIONS.
+    """
+    if config['DATABASE_MAX_CONNECTIONS']:
+        return RoutedPooledSqliteDatabase(config['DATABASE_PATH'],
+                                          read_connections=config['DATABASE_READ_CONNECTIONS'],
+                                          pragmas=config['DATABASE_PRAGMAS'],
+                                          max_connections=config['DATABASE_MAX_CONNECTIONS'],
+                                          stale_timeout=config['DATABASE_STALE_TIMEOUT'])
+    return RoutedSqliteDatabase(config['DATABASE_PATH'],
+                                read_connections=config['DATABASE_READ_CONNECTIONS'],
+                                pragmas=config['DATABASE_PRAGMAS'])
+
+
+def create_app(config=None):
+    """ Создает приложение; config - класс или объект настроек (как для from_object),
+    по умолчанию Config из config.py. Незаданные настройки берутся из DefaultConfig.
+
+    Соединение с базой открывается на первом запросе, файл лога - при первой
+    записи, пул хэширования паролей - при первом хэшировании, фоновая
+    очистка токенов запускается первым запросом.
+    """
+    if config is None:
+        from config import Config as config
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    app.config.from_object(config)
+    setup_logging(app)
+    app.extensions['database'] = make_database(app.config)
+    Metrics().init_app(app)
+    TokenCache().init_app(app)
+    app.extensions['metrics'].add_collector('api_token_cache', app.extensions['token_cache'].stats)
+    app.extensions['response_cache'] = make_response_cache(app.config)
+    hashing.init_app(app)
+
+    app.before_first_request(start_sweeper)
+    app.before_request(db_connect)
+    app.teardown_request(db_close)
+
+    from app import errors, cli
+    from app.routes import bp as main_bp
+    from app.api import bp as api_bp
+    errors.init_app(app)
+    cli.init_app(app)
+    app.register_blueprint(main_bp)
+    app.register_blueprint(api_bp, url_prefix='/api')
+
+    app.jinja_env.globals['my_global_var'] = 'my_global_var`s_value'
+    return app
+
+
+def post_fork(app, worker_id=0):
+    """ Готовит процесс-воркер, полученный fork от процесса с созданным приложением.
+
+    Соединения, потоки и открытые файлы родителя в воркере не используются:
+    база, лог (свой файл у каждого воркера) и пул хэширования создаются
+    заново, кэши процесса очищаются. Фоновую очистку токенов запускает
+    только воркер 0.
+    """
+    from app.sweeper import start_token_sweeper
+    app.extensions['database'] = make_database(app.config)
+    app.extensions['token_cache'].clear()
+    response_cache = app.extensions['response_cache']
+    if response_cache is not None:
+        response_cache.close()
+    setup_logging(app, worker_id)
+    hashing.init_app(app)
+    app.extensions['token_sweeper'] = start_token_sweeper(app) if worker_id == 0 else None
+
+
+def start_sweeper():
+    """ Запускает очистку токенов в процессе, который обслуживает запросы (flask run, WSGI-сервер).
+
+    Команды flask и импорт приложения потоков не запускают. Воркерам
+    app.server решение принимает post_fork.
+    """
+    from app.sweeper import start_token_sweeper
+    app = current_app._get_current_object()
+    if 'token_sweeper' not in app.extensions:
+        app.extensions['token_sweeper'] = start_token_sweeper(app)
+
+
+def db_connect():
+    db.connect(reuse_if_open=True)
+
+
+def db_close(exc):
+    # для пула соединение возвращается в пул; подзапросы пакета (POST /api/batch)
+    # завершаются внутри своих транзакций, соединение закрывает сам пакет
+    if not db.is_closed() and not db.in_transaction():
+        db.close()
@@ -1,7 +1,7 @@
-from flask import g
+from flask import g, request
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
-from app.api.errors import WrongDataError, InvalidTokenError
+from app.api.errors import WrongDataError, InvalidTokenError, RightsError
 
 basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
@@ -13,7 +13,13 @@ def verify_password(username, password):
     if user is None:
         return False
     g.current_user = user
-    return user.check_password(password)
+    if not user.check_password(password):
+        return False
+    if user.password_needs_rehash():
+        # прозрачный перевод старого хэша на текущие PASSWORD_HASH_METHOD/PASSWORD_SALT_LENGTH
+        user.set_password(password)
+        User.update(password_hash=user.password_hash).where(User.id == user.id).execute()
+    return True
 
 
 @basic_auth.error_handler
@@ -23,10 +29,24 @@ def basic_auth_error():
 
 @token_auth.verify_token
 def verify_token(token):
-    g.current_user = User.check_token(token) if token else None
+    g.current_token = token
+    # подзапросы пакета (POST /api/batch) делят словарь проверенных токенов
+    checked = request.environ.get('api.checked_tokens', {})
+    if token not in checked:
+        checked[token] = User.check_token(token) if token else None
+    g.current_user = checked[token]
     return g.current_user is not None
 
 
 @token_auth.error_handler
 def token_auth_error():
     raise InvalidTokenError()
+
+
+def check_admin():
+    """ RightsError, если текущий пользователь не администратор.
+
+    Права проверяются по базе, а не по пользователю из кэша токенов.
+    """
+    if not User.select(User.admin).where(User.id == g.current_user.id).scalar():
+        raise RightsError()
@@ -0,0 +1,102 @@
+from app.api import bp
+from app.api.logging import logging_request
+from app.encoding import dumps
+from app.models import User
+import app.api.errors as apiErr
+from flask import current_app, request
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
+
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+
+
+@bp.route('/batch', methods=['POST'])
+@logging_request(logging_rr=False, extra=lambda: log_subrequests())
+def batch():
+    """ Выполняет по порядку подзапросы к API за один HTTP-запрос.
+
+    Тело: {"requests": [{"method": "GET", "path": "/users/1", "body": {...}}, ...]},
+    path - без префикса /api. Заголовок Authorization пакета передается
+    подзапросам без своего, токен проверяется один раз на пакет. Каждый
+    подзапрос выполняется в своей транзакции: изменения подзапроса,
+    завершившегося ошибкой, откатываются, изменения остальных сохраняются.
+    Запись в базу блокируется только на время одного подзапроса, а пароли
+    хэшируются в общем пуле с его ограничением очереди, как у отдельных
+    запросов. Ответ: {"responses": [{"status": 200, "body": {...}}, ...]},
+    в теле ошибки остается ее code.
+    """
+    subrequests = validate_batch(request.get_json(silent=True))
+    shared = {'api.batch': True, 'api.checked_tokens': {}}
+    authorization = request.headers.get('Authorization')
+
+    responses = []
+    database = User._meta.database
+    for subrequest in subrequests:
+        headers = Headers(subrequest.get('headers') or {})
+        if authorization and 'Authorization' not in headers:
+            headers['Authorization'] = authorization
+        environ = EnvironBuilder(path='/api' + subrequest['path'], method=subrequest['method'],
+                                 json=subrequest.get('body'), headers=headers).get_environ()
+        environ.update(shared)
+        with database.atomic() as transaction:
+            status, body = dispatch(environ)
+            if status >= 400:
+                transaction.rollback()
+        responses.append(b'{"status":%d,"body":%s}' % (status, body))
+
+    return current_app.response_class(b'{"responses":[' + b','.join(responses) + b']}',
+                                      mimetype='application/json')
+
+
+def log_subrequests():
+    """ Поля записи лога пакета: только метод и путь подзапросов.
+
+    Заголовки (Authorization) и тела (пароли) подзапросов, как и ответы
+    с токенами, в лог не попадают.
+    """
+    data = request.get_json(silent=True)
+    subrequests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(subrequests, list):
+        return {}
+    return {'requests': [f'{subrequest.get("method")} {subrequest.get("path")}'
+                         for subrequest in subrequests[:current_app.config['BATCH_MAX_REQUESTS']]
+                         if isinstance(subrequest, dict)]}
+
+
+def validate_batch(data):
+    """ Список подзапросов из тела запроса или ApiError. """
+    subrequests = data.get('requests') if isinstance(data, dict) else None
+    if not isinstance(subrequests, list) or not subrequests:
+        raise apiErr.InsufficientDataError('Must include non-empty requests list.')
+    max_requests = current_app.config['BATCH_MAX_REQUESTS']
+    if len(subrequests) > max_requests:
+        raise apiErr.InvalidParamsError(f'No more than {max_requests} requests in batch.')
+    for subrequest in subrequests:
+        if not isinstance(subrequest, dict) or subrequest.get('method') not in BATCH_METHODS \
+                or not isinstance(subrequest.get('path'), str) or not subrequest['path'].startswith('/') \
+                or not isinstance(subrequest.get('headers') or {}, dict):
+            raise apiErr.InvalidParamsError(
+                f'Each request must include method ({", ".join(BATCH_METHODS)}) and path starting with /.')
+    return subrequests
+
+
+def dispatch(environ):
+    """ Выполняет подзапрос и возвращает статус и тело ответа (JSON в bytes).
+
+    Подзапрос получает свой контекст приложения (свой g), поэтому текущий
+    пользователь и метрики пакета и подзапросов не смешиваются.
+    """
+    with current_app.app_context(), current_app.request_context(environ) as ctx:
+        rule = ctx.request.url_rule
+        if ctx.request.routing_exception is not None or ctx.request.blueprint != 'api' \
+                or rule.endpoint == 'api.batch':
+            error = apiErr.NotFoundError()
+            return error.http_code, error.get_body()
+        response = current_app.full_dispatch_request()
+        # тело читается внутри контекста: потоковые ответы генерируются здесь же
+        data = response.get_data()
+        if not data:
+            return response.status_code, b'null'
+        if response.is_json:
+            return response.status_code, data
+        return response.status_code, dumps(data.decode('utf-8', 'replace'))
@@ -0,0 +1,51 @@
+from app.cache import CachedResponse
+from flask import current_app, request, Response
+from functools import wraps
+
+
+def cached_response(key, tags):
+    """ Кэширует успешные ответы вью.
+
+    key(**kwargs) и tags(**kwargs) по аргументам вью возвращают ключ ответа
+    и теги, по которым он инвалидируется (см. invalidate). Ключ должен
+    учитывать пользователя, если от него зависит ответ.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            response_cache = current_app.extensions['response_cache']
+            if response_cache is None:
+                return func(*args, **kwargs)
+
+            cache_key = key(**kwargs)
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                response = Response(entry.body, entry.status, mimetype=entry.mimetype)
+                if entry.etag:
+                    response.set_etag(entry.etag)
+                return response.make_conditional(request)
+
+            generation = response_cache.generation()
+            response = func(*args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                etag, _ = response.get_etag()
+                response_cache.set(cache_key, CachedResponse(
+                    response.get_data(), response.status_code, response.mimetype, etag
+                ), tags(**kwargs), generation)
+            return response
+        return wrapper
+    return decorator
+
+
+def invalidate(*tags):
+    """ Сбрасывает закэшированные ответы с указанными тегами. """
+    response_cache = current_app.extensions['response_cache']
+    if response_cache is not None:
+        response_cache.invalidate(*tags)
+
+
+def invalidate_all():
+    """ Сбрасывает весь кэш ответов. """
+    response_cache = current_app.extensions['response_cache']
+    if response_cache is not None:
+        response_cache.clear()
@@ -1,23 +1,22 @@
-from flask import jsonify
 from app.api import bp
 from app.models import User
 from app.api.tokens import confirm_token
 from app.api.logging import logging_request
+from app.api.caching import invalidate
+from app.encoding import json_response
 import app.api.errors as apiErr
 
 
 @bp.route('/confirm/<token>')
 @logging_request(logging_rr=False)
 def confirm(token):
-    email = confirm_token(token)
-    if not email:
+    user_id = confirm_token(token)
+    if user_id is None:
         raise apiErr.InvalidLincError()
-    user = User.get_or_none(User.email == email)
-    if not user:
+    if not User.confirm(user_id):
+        if User.select().where(User.id == user_id).exists():
+            raise apiErr.AlreadyConfirmedError()
         raise apiErr.InvalidLincError()
-    if user.confirmed:
-        raise apiErr.AlreadyConfirmedError()
 
-    user.confirmed = True
-    user.save()
-    return jsonify({'message': 'Email confirmed.'})
+    invalidate('users', f'user:{user_id}')
+    return json_response({'message': 'Email confirmed.'})
@@ -1,20 +1,37 @@
-from flask import make_response, jsonify
+from flask import current_app
+from app.encoding import dumps
 
 
 class ApiError(Exception):
     """ Общее api исключение. """
 
+    # закодированные тела ответов с сообщением по умолчанию: класс -> bytes
+    _default_bodies = {}
+
     def __init__(self, message, http_code, api_code):
         self.http_code = http_code
         self.api_code = api_code
         self.message = message
 
     def make_response(self):
-        return make_response(jsonify({
+        return current_app.response_class(self.get_body(), status=self.http_code,
+                                          mimetype='application/json')
+
+    def get_body(self):
+        defaults = type(self).__init__.__defaults__
+        if not defaults or defaults[0] != self.message:
+            return self.encode_body()
+        body = self._default_bodies.get(type(self))
+        if body is None:
+            body = self._default_bodies[type(self)] = self.encode_body()
+        return body
+
+    def encode_body(self):
+        return dumps({
             # 'status': self.api_code,
             'message': self.message,
             'code': self.api_code
-        }), self.http_code)
+        })
 
 
 class AlreadyConfirmedError(ApiError):
@@ -85,3 +102,17 @@ class EmailUsedError(ApiError):
 
     def __init__(self, message='Please use a different email.'):
         super().__init__(message, http_code=400, api_code=1009)
+
+
+class InvalidParamsError(ApiError):
+    """ Исключение. Неверные параметры запроса. """
+
+    def __init__(self, message='Invalid request parameters.'):
+        super().__init__(message, http_code=400, api_code=1010)
+
+
+class BusyError(ApiError):
+    """ Исключение. Сервер перегружен. """
+
+    def __init__(self, message='Server is busy, try again later.'):
+        super().__init__(message, http_code=503, api_code=1011)
@@ -1,26 +1,74 @@
-from app import app
-from flask import request, g
+from app.api.errors import ApiError
+from flask import current_app, request, g
 from functools import wraps
+from random import random
+from time import perf_counter
 
 
-def logging_request(logging_rr=True):
+def logging_request(logging_rr=True, extra=None):
+    """ Пишет в лог одну запись на запрос.
+
+    logging_rr - включать ли в запись тела запроса и ответа (обрезаются до
+    LOG_PAYLOAD_LIMIT байт). extra - функция без аргументов, возвращающая
+    дополнительные поля записи (например, сведения о запросе без секретов
+    из его тела). Успешные запросы попадают в лог с вероятностью
+    LOG_SAMPLE_RATE, ошибки - всегда. Запись кодируется и пишется на диск
+    в фоновом потоке. Подзапросы пакета (POST /api/batch) отдельно не
+    пишутся: в лог попадает запись самого пакета.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if logging_rr:
-                app.logger.info({'request': request.get_json() or {}})
-                app.logger.info({
-                    'user_id': g.current_user.id if 'current_user' in g and g.current_user else None
-                })
+            if request.environ.get('api.batch'):
+                return func(*args, **kwargs)
+            start = perf_counter()
+            response = None
+            status = 500
+            try:
+                response = func(*args, **kwargs)
+                status = response.status_code
+                return response
+            except ApiError as e:
+                status = e.http_code
+                raise
+            finally:
+                if status >= 400 or random() < current_app.config['LOG_SAMPLE_RATE']:
+                    current_app.logger.info(make_record(response, status, start, logging_rr, extra))
+        return wrapper
+    return decorator
 
-            response = func(*args, **kwargs)
 
-            if logging_rr:
-                app.logger.info({'response': response.get_json() or {}})
+def request_fields(*names):
+    """ extra для logging_request: только перечисленные поля JSON-тела запроса.
 
-            return response
-        return wrapper
-    return decorator
+    Для запросов с паролями: тело целиком в лог не пишется.
+    """
+    def extra():
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {}
+        limit = current_app.config['LOG_PAYLOAD_LIMIT']
+        return {'request': {name: data[name][:limit] if isinstance(data[name], str) else data[name]
+                            for name in names if name in data}}
+    return extra
+
+
+def make_record(response, status, start, logging_rr, extra=None):
+    record = {
+        'method': request.method,
+        'path': request.full_path if request.query_string else request.path,
+        'status': status,
+        'user_id': g.current_user.id if 'current_user' in g and g.current_user else None,
+        'duration_ms': round((perf_counter() - start) * 1000, 3)
+    }
+    if extra is not None:
+        record.update(extra())
+    if logging_rr:
+        limit = current_app.config['LOG_PAYLOAD_LIMIT']
+        record['request'] = request.get_data()[:limit]
+        if response is not None and not response.is_streamed:
+            record['response'] = response.get_data()[:limit]
+    return record
 
 
 # def logging_request(func):
@@ -0,0 +1,16 @@
+from flask import Response
+from app.api import bp
+from app.metrics import metrics
+import app.api.errors as apiErr
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """ Возвращает метрики в текстовом формате Prometheus.
+
+    Счетчики хранятся в памяти процесса: при нескольких воркерах (app.server)
+    ответ содержит метрики только ответившего воркера, суммировать их должен сборщик.
+    """
+    if not metrics.enabled:
+        raise apiErr.NotFoundError()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
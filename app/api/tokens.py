@@ -1,26 +1,34 @@
-from app import app
-from flask import jsonify, g
+from flask import current_app, g, request
 from app.api import bp
-from app.api.auth import basic_auth, token_auth
-from itsdangerous import URLSafeSerializer, BadSignature
-from app.api.errors import NotConfirmedError
+from app.api.auth import basic_auth, token_auth, check_admin
+from app.api.caching import invalidate, invalidate_all
+from app.api.logging import logging_request
+from app.encoding import json_response
+from app.models import User
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from app.api.errors import NotConfirmedError, InsufficientDataError, InvalidParamsError
+
+
+def get_confirmation_serializer():
+    """ Сериализатор ссылок подтверждения, создается один раз на приложение. """
+    serializer = current_app.extensions.get('confirmation_serializer')
+    if serializer is None:
+        serializer = current_app.extensions['confirmation_serializer'] = URLSafeTimedSerializer(
+            current_app.config['SECRET_KEY'], salt=current_app.config['SECURITY_PASSWORD_SALT'])
+    return serializer
 
 
 def generate_confirmation_token(user):
-    serializer = URLSafeSerializer(app.config['SECRET_KEY'])
-    return serializer.dumps(user.email, salt=app.config['SECURITY_PASSWORD_SALT'])
+    """ Подписанный токен с id пользователя и временем выдачи. """
+    return get_confirmation_serializer().dumps(user.id)
 
 
 def confirm_token(token):
-    serializer = URLSafeSerializer(app.config['SECRET_KEY'])
+    """ Возвращает id пользователя или None, если токен неверен или истек. """
     try:
-        email = serializer.loads(
-            token,
-            salt=app.config['SECURITY_PASSWORD_SALT']
-        )
-    except BadSignature:
-        return False
-    return email
+        return get_confirmation_serializer().loads(token, max_age=current_app.config['CONFIRM_TOKEN_MAX_AGE'])
+    except BadSignature:  # в том числе SignatureExpired
+        return None
 
 
 @bp.route('/tokens', methods=['POST'])
@@ -32,12 +40,44 @@ def get_token():
         raise NotConfirmedError('Email not confirmed. Link to confirm email: ' +
                                f'<domen>/confirm/{token}')
     token = g.current_user.get_token()
-    return jsonify({'token': token})
+    invalidate(f'user:{g.current_user.id}')
+    return json_response({'token': token})
 
 
 @bp.route('/tokens', methods=['DELETE'])
 @token_auth.login_required
 def revoke_token():
-    g.current_user.revoke_token()
+    """ Закрывает сессию текущего токена, остальные сессии пользователя остаются. """
+    g.current_user.revoke_token(g.current_token)
+    request.environ.get('api.checked_tokens', {}).pop(g.current_token, None)
+    invalidate(f'user:{g.current_user.id}')
     return '', 204
     # код состояния 204 используется для успешных запросов без тела ответа.
+
+
+@bp.route('/tokens/revoke', methods=['POST'])
+@token_auth.login_required
+@logging_request()
+def revoke_tokens():
+    """ Отзывает токены всех ({"all": true}) или выбранных ({"ids": [...]}) пользователей.
+
+    Только для администратора, выполняется одним DELETE по таблице сессий.
+    """
+    check_admin()
+
+    data = request.get_json() or {}
+    ids = data.get('ids')
+    if data.get('all') is True:
+        ids = None
+    elif not isinstance(ids, list) or not ids:
+        raise InsufficientDataError('Must include non-empty ids list or all: true.')
+    elif not all(isinstance(id, int) for id in ids) or len(ids) > current_app.config['USERS_BATCH_MAX_SIZE']:
+        raise InvalidParamsError(f'Ids must be integers, no more than {current_app.config["USERS_BATCH_MAX_SIZE"]}.')
+
+    revoked = User.revoke_tokens(ids)
+    request.environ.get('api.checked_tokens', {}).clear()
+    if ids is None:
+        invalidate_all()
+    else:
+        invalidate(*[f'user:{id}' for id in ids])
+    return json_response({'revoked': revoked})
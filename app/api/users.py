@@ -1,10 +1,15 @@
+from app import token_cache
 from app.api import bp
-from app.api.auth import token_auth
+from app.api.auth import token_auth, check_admin
+from app.api.caching import cached_response, invalidate
+from app.encoding import dumps, json_response
 # from app.api.errors import error_response
-from app.api.logging import logging_request
+from app.api.logging import logging_request, request_fields
 from app.api.tokens import generate_confirmation_token
-from app.models import User
-from flask import jsonify, request, g
+from app.hashing import hash_passwords
+from app.models import User, TableVersion
+from peewee import IntegrityError, PeeweeException
+from flask import current_app, request, g, url_for, Response, stream_with_context
 import app.api.errors as apiErr
 
 # @bp.before_request
@@ -28,74 +33,410 @@ import app.api.errors as apiErr
 #     return response
 
 
+def has_rights(user):
+    """ Доступ к учетной записи есть только у ее владельца. """
+    return g.current_user.get_id() == user.get_id()
+
+
+def not_modified(etag):
+    """ Ответ 304, если у клиента актуальная версия (If-None-Match), иначе None. """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def get_fields_param(allowed):
+    """ Разбирает параметр fields=id,username; None - все поля. """
+    if 'fields' not in request.args:
+        return None
+    fields = list(dict.fromkeys(field for field in request.args['fields'].split(',') if field))
+    if not fields or not set(fields) <= set(allowed):
+        raise apiErr.InvalidParamsError(f'Fields must be a subset of: {",".join(allowed)}.')
+    return fields
+
+
+def get_ids_param():
+    """ Разбирает параметр ids=1,2,3 (без повторов, с сохранением порядка). """
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args['ids'].split(',')))
+    except ValueError:
+        raise apiErr.InvalidParamsError('Ids must be comma-separated integers.')
+    if len(ids) > current_app.config['USERS_MAX_PER_PAGE']:
+        raise apiErr.InvalidParamsError(
+            f'No more than {current_app.config["USERS_MAX_PER_PAGE"]} ids per request.')
+    return ids
+
+
+def get_page_params(stream=False):
+    """ Разбирает параметры limit/cursor постраничной выдачи.
+
+    В потоковом режиме limit не ограничивается и по умолчанию не задан.
+    """
+    default_limit = None if stream else current_app.config['USERS_PER_PAGE']
+    try:
+        limit = request.args.get('limit', default_limit)
+        limit = int(limit) if limit is not None else None
+        cursor = request.args.get('cursor')
+        cursor = int(cursor) if cursor is not None else None
+    except ValueError:
+        raise apiErr.InvalidParamsError('Limit and cursor must be integers.')
+    if limit is not None and limit < 1 or cursor is not None and cursor < 0:
+        raise apiErr.InvalidParamsError('Limit must be positive, cursor non-negative.')
+    if not stream:
+        limit = min(limit, current_app.config['USERS_MAX_PER_PAGE'])
+    return limit, cursor
+
+
+# сообщения SQLite о нарушении уникальных индексов пользователя
+UNIQUE_ERRORS = {
+    'UNIQUE constraint failed: user.username': apiErr.NameUsedError,
+    'UNIQUE constraint failed: user.email': apiErr.EmailUsedError,
+}
+
+
+def save_user(user):
+    """ Сохраняет пользователя одним запросом.
+
+    Проверку занятости username/email выполняют уникальные индексы,
+    нарушение переводится в NameUsedError/EmailUsedError, остальные
+    нарушения ограничений (например, NOT NULL) - в InvalidParamsError.
+    """
+    try:
+        with User._meta.database.atomic():
+            user.save()
+    except IntegrityError as e:
+        error = UNIQUE_ERRORS.get(str(e))
+        if error is not None:
+            raise error()
+        raise apiErr.InvalidParamsError('User could not be saved.')
+
+
+def stream_collection(rows):
+    """ Кодирует строки коллекции по одной и отдает JSON-массив частями. """
+    chunk_size = current_app.config['USERS_STREAM_CHUNK_SIZE']
+    chunk = [b'{"items":[']
+    separator = b''
+    for row in rows:
+        chunk.append(separator + dumps(row))
+        separator = b','
+        if len(chunk) >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(b']}')
+    yield b''.join(chunk)
+
+
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 @logging_request(logging_rr=False)
+@cached_response(key=lambda id: f'user:{g.current_user.id}:{request.full_path}',
+                 tags=lambda id: [f'user:{id}'])
 def get_user(id):
-    """ Возвращает пользователя. """
-    user = User.get_or_none(User.id == id)
+    """ Возвращает пользователя (с fields= - только указанные поля). """
+    fields = get_fields_param(User.PRIVATE_FIELDS)
+    user = User.select_fields(fields or User.PRIVATE_FIELDS, User.id, User.version) \
+        .where(User.id == id).first()
     if not user:
         raise apiErr.NotFoundError('User not found.')
-    if g.current_user.get_id != user.get_id:
+    if not has_rights(user):
         raise apiErr.RightsError()
-    return jsonify(user.to_dict(include_email=True))
+
+    etag = user.get_etag()
+    response = not_modified(etag) or json_response(user.to_dict(include_email=True, fields=fields))
+    response.set_etag(etag)
+    return response
+
+
+def users_cache_key():
+    if 'ids' in request.args:  # состав ответа зависит от прав
+        return f'users:{g.current_user.id}:{request.full_path}'
+    return f'users::{request.full_path}'
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
 @logging_request()
+@cached_response(key=users_cache_key, tags=lambda: ['users'])
 def get_users():
-    """ Возвращает коллекцию всех пользователей. """
-    data = User.to_collection_dict()
+    """ Возвращает страницу коллекции пользователей.
+
+    С параметром stream=1 коллекция читается построчно и отдается потоком,
+    с параметром ids=1,2,3 возвращаются указанные пользователи,
+    с параметром fields=id,username - только указанные поля.
+    ETag строится по версии таблицы, поэтому 304 отдается без чтения строк.
+    """
+    etag = f'users-{TableVersion.get_version("user")}'
+    if 'ids' in request.args:
+        etag += f'-{g.current_user.id}'  # состав ответа зависит от прав
+    response = not_modified(etag) or build_users_response()
+    response.set_etag(etag)
+    return response
+
+
+def build_users_response():
+    if 'ids' in request.args:
+        return get_users_by_ids(get_ids_param(), get_fields_param(User.PRIVATE_FIELDS))
+
+    fields = get_fields_param(User.PUBLIC_FIELDS)
+    stream = request.args.get('stream') in ('1', 'true')
+    limit, cursor = get_page_params(stream)
+    if stream:
+        rows = User.iter_collection_rows(cursor, limit, fields)
+        return Response(stream_with_context(stream_collection(rows)), mimetype='application/json')
+
+    data = User.to_collection_dict(limit, cursor, fields)
     if not data:  # в теории невозможно
         raise apiErr.NotFoundError('Users not found.')
-    return jsonify(data)
 
+    next_cursor = data['_meta']['next_cursor']
+    fields = request.args.get('fields')
+    data['_links'] = {
+        'self': url_for('api.get_users', limit=limit, cursor=cursor, fields=fields),
+        'next': url_for('api.get_users', limit=limit, cursor=next_cursor, fields=fields) if next_cursor else None
+    }
+    return json_response(data)
 
-@bp.route('/users', methods=['POST'])
+
+def get_users_by_ids(ids, fields=None):
+    """ Возвращает пользователей по списку id одним запросом к базе.
+
+    Права проверяются для каждого пользователя так же, как в get_user.
+    """
+    users = User.get_many(ids, fields)
+    data = {'items': [], 'missing': [], 'errors': []}
+    for id in ids:
+        user = users.get(id)
+        if user is None:
+            data['missing'].append(id)
+        elif not has_rights(user):
+            error = apiErr.RightsError()
+            data['errors'].append({'id': id, 'code': error.api_code, 'message': error.message})
+        else:
+            data['items'].append(user.to_dict(include_email=True, fields=fields))
+    return json_response(data)
+
+
+@bp.route('/users/changes', methods=['GET'])
+@token_auth.login_required
 @logging_request()
+@cached_response(key=lambda: f'users::{request.full_path}', tags=lambda: ['users'])
+def get_users_changes():
+    """ Лента изменений: пользователи, созданные или измененные после курсора since.
+
+    Клиент передает в since значение _meta.next_cursor прошлого ответа,
+    пока _meta.has_more == true. Стоимость запроса зависит только от числа изменений.
+    """
+    etag = f'users-{TableVersion.get_version("user")}'
+    response = not_modified(etag)
+    if response is None:
+        try:
+            since = int(request.args.get('since', 0))
+            limit = int(request.args.get('limit', current_app.config['USERS_PER_PAGE']))
+        except ValueError:
+            raise apiErr.InvalidParamsError('Since and limit must be integers.')
+        if since < 0 or limit < 1:
+            raise apiErr.InvalidParamsError('Limit must be positive, since non-negative.')
+        limit = min(limit, current_app.config['USERS_MAX_PER_PAGE'])
+        response = json_response(User.get_changes(since, limit))
+    response.set_etag(etag)
+    return response
+
+
+@bp.route('/users/search', methods=['GET'])
+@token_auth.login_required
+@logging_request()
+@cached_response(key=lambda: f'users::{request.full_path}', tags=lambda: ['users'])
+def search_users():
+    """ Поиск пользователей по началу username или по email целиком (параметр q).
+
+    Результаты упорядочены по релевантности, страницы задаются limit/offset,
+    поля - параметром fields.
+    """
+    etag = f'users-{TableVersion.get_version("user")}'
+    response = not_modified(etag)
+    if response is None:
+        q = request.args.get('q', '').strip()
+        min_length = current_app.config['USERS_SEARCH_MIN_LENGTH']
+        if not min_length <= len(q) <= 128:
+            raise apiErr.InvalidParamsError(f'Query must be from {min_length} to 128 characters.')
+        fields = get_fields_param(User.PUBLIC_FIELDS)
+        try:
+            limit = int(request.args.get('limit', current_app.config['USERS_PER_PAGE']))
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            raise apiErr.InvalidParamsError('Limit and offset must be integers.')
+        if limit < 1 or offset < 0:
+            raise apiErr.InvalidParamsError('Limit must be positive, offset non-negative.')
+        limit = min(limit, current_app.config['USERS_MAX_PER_PAGE'])
+
+        data = User.search(q, limit, offset, fields)
+        next_offset = data['_meta']['next_offset']
+        fields = request.args.get('fields')
+        data['_links'] = {
+            'self': url_for('api.search_users', q=q, limit=limit, offset=offset, fields=fields),
+            'next': url_for('api.search_users', q=q, limit=limit, offset=next_offset, fields=fields)
+            if next_offset is not None else None
+        }
+        response = json_response(data)
+    response.set_etag(etag)
+    return response
+
+
+@bp.route('/users', methods=['POST'])
+@logging_request(logging_rr=False, extra=request_fields('username', 'email', 'birthday'))
 def create_user():
     """ Регистрирует новую учетную запись пользователя. """
     data = request.get_json() or {}
     if 'username' not in data or 'email' not in data or 'password' not in data:
         raise apiErr.InsufficientDataError('Must include username, email and password fields.')
 
-    if User.get_or_none(User.username == data['username']):
-        raise apiErr.NameUsedError()
-
-    if User.get_or_none(User.email == data['email']):
-        raise apiErr.EmailUsedError()
-
     user = User()
     user.from_dict(data, new_user=True)
-    user.save()
+    save_user(user)
+    invalidate('users')
     token = generate_confirmation_token(user)
-    response = jsonify({
+    response = json_response({
         'message': f'Link to confirm email: <domain>/confirm/{token}'})
     return response
 
 
+def validate_batch(items):
+    """ Проверяет элементы пачки; возвращает словарь index -> ApiError. """
+    errors = {}
+    names, emails = set(), set()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or \
+                'username' not in item or 'email' not in item or 'password' not in item:
+            errors[index] = apiErr.InsufficientDataError('Must include username, email and password fields.')
+        elif not all(isinstance(item[field], str) for field in ('username', 'email', 'password')):
+            errors[index] = apiErr.InvalidParamsError('Username, email and password must be strings.')
+        elif not isinstance(item.get('birthday'), (str, type(None))):
+            errors[index] = apiErr.InvalidParamsError('Birthday must be a string.')
+        elif item['username'] in names:
+            errors[index] = apiErr.NameUsedError()
+        elif item['email'] in emails:
+            errors[index] = apiErr.EmailUsedError()
+        else:
+            names.add(item['username'])
+            emails.add(item['email'])
+
+    chunk_size = current_app.config['USERS_BATCH_CHUNK_SIZE']
+    used_names, used_emails = set(), set()
+    names, emails = list(names), list(emails)
+    for i in range(0, len(names), chunk_size):
+        used_names.update(name for name, in User.select(User.username).where(
+            User.username.in_(names[i:i + chunk_size])).tuples())
+        used_emails.update(email for email, in User.select(User.email).where(
+            User.email.in_(emails[i:i + chunk_size])).tuples())
+
+    for index, item in enumerate(items):
+        if index in errors:
+            continue
+        if item['username'] in used_names:
+            errors[index] = apiErr.NameUsedError()
+        elif item['email'] in used_emails:
+            errors[index] = apiErr.EmailUsedError()
+    return errors
+
+
+def insert_users(rows, errors):
+    """ Вставляет пользователей пачками через insert_many, каждую пачку в своей транзакции.
+
+    rows - список пар (index, row). Если пачка не вставилась (например, конфликт
+    уникальности при гонке с параллельной регистрацией), она вставляется построчно,
+    ошибка строки записывается в errors.
+    """
+    database = User._meta.database
+    chunk_size = current_app.config['USERS_BATCH_CHUNK_SIZE']
+    for i in range(0, len(rows), chunk_size):
+        chunk = rows[i:i + chunk_size]
+        try:
+            with database.atomic():
+                User.insert_many([row for _, row in chunk]).execute()
+        except PeeweeException:
+            for index, row in chunk:
+                try:
+                    save_user(User(**row))
+                except apiErr.ApiError as e:
+                    errors[index] = e
+                except PeeweeException:
+                    errors[index] = apiErr.InvalidParamsError('User could not be saved.')
+
+
+@bp.route('/users/batch', methods=['POST'])
+@token_auth.login_required
+@logging_request(logging_rr=False)
+def create_users():
+    """ Регистрирует пачку учетных записей (только для администратора).
+
+    Возвращает результат для каждого элемента в порядке передачи.
+    """
+    check_admin()
+    data = request.get_json() or {}
+    if not isinstance(data, dict):
+        raise apiErr.InsufficientDataError('Must include non-empty items list.')
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        raise apiErr.InsufficientDataError('Must include non-empty items list.')
+    if len(items) > current_app.config['USERS_BATCH_MAX_SIZE']:
+        raise apiErr.InvalidParamsError(
+            f'Batch size must not exceed {current_app.config["USERS_BATCH_MAX_SIZE"]}.')
+
+    errors = validate_batch(items)
+    valid = [index for index in range(len(items)) if index not in errors]
+    hashes = hash_passwords([items[index]['password'] for index in valid])
+    rows = [(index, {
+        'username': items[index]['username'],
+        'email': items[index]['email'],
+        'birthday': items[index].get('birthday'),
+        'password_hash': password_hash,
+        'confirmed': False
+    }) for index, password_hash in zip(valid, hashes)]
+    insert_users(rows, errors)
+    invalidate('users')
+
+    created = {}
+    names = [row['username'] for index, row in rows if index not in errors]
+    chunk_size = current_app.config['USERS_BATCH_CHUNK_SIZE']
+    for i in range(0, len(names), chunk_size):
+        for user in User.select(User.id, User.username, User.email).where(
+                User.username.in_(names[i:i + chunk_size])):
+            created[user.username] = user
+
+    result = []
+    for index, item in enumerate(items):
+        if index in errors:
+            result.append({'index': index, 'code': errors[index].api_code, 'message': errors[index].message})
+            continue
+        user = created[item['username']]
+        token = generate_confirmation_token(user)
+        result.append({
+            'index': index,
+            'id': user.id,
+            'message': f'Link to confirm email: <domain>/confirm/{token}'
+        })
+    return json_response({'items': result})
+
+
 @bp.route('/users/<int:id>', methods=['PUT'])
 @token_auth.login_required
-@logging_request()
+@logging_request(logging_rr=False, extra=request_fields('username', 'email', 'birthday'))
 def update_user(id):
     """ Изменяет пользователя. """
     user = User.get_or_none(User.id == id)
 
     if not user:
         raise apiErr.NotFoundError()
-    if g.current_user.get_id != user.get_id:
+    if not has_rights(user):
         raise apiErr.RightsError()
 
     data = request.get_json() or {}
 
-    if 'username' in data and data['username'] != user.username and \
-            User.get_or_none(User.username == data['username']):
-        raise apiErr.NameUsedError()
-    if 'email' in data and data['email'] != user.email and \
-            User.get_or_none(User.email == data['email']):
-        raise apiErr.EmailUsedError()
-
     user.from_dict(data, new_user=False)
-    user.save()
-    return jsonify(user.to_dict(include_email=True))
+    if user.is_dirty():
+        save_user(user)
+        token_cache.invalidate_user(user.id)
+        invalidate('users', f'user:{user.id}')
+    return json_response(user.to_dict(include_email=True))
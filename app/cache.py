@@ -0,0 +1,395 @@
+import mmap
+import os
+import sqlite3
+import struct
+from collections import OrderedDict, namedtuple
+from threading import Lock, local
+from time import monotonic, time
+
+try:
+    import fcntl
+except ImportError:  # Windows: ревизии увеличиваются без блокировки файла
+    fcntl = None
+
+
+class TokenRevisions(object):
+    """ Общие для процессов ревизии отзыва токенов: счетчики в файле, отображенном в память.
+
+    Ячейка 0 - эпоха (растет при каждом отзыве), 1 - отзыв токенов всех
+    пользователей, остальные - ревизии пользователей (user_id % slots, ячейку
+    делят несколько пользователей). Чтение - обращение к памяти, без SQL;
+    увеличение - под блокировкой файла, так что отзыв в CLI или другом воркере
+    сразу виден всем процессам. path=None - анонимная память, общая только
+    с дочерними процессами (fork).
+    """
+
+    def __init__(self, path=None, slots=16384):
+        self.path = path
+        self.slots = slots
+        self._fd = None
+        self._map = None
+        self._lock = Lock()
+
+    def epoch(self):
+        return self._read(0)
+
+    def get(self, user_id):
+        """ Ревизия токенов пользователя: меняется при отзыве его токенов или токенов всех. """
+        return self._read(1) + self._read(2 + user_id % self.slots)
+
+    def bump(self, user_ids=None):
+        """ Отмечает отзыв токенов пользователей user_ids (None - всех).
+
+        Эпоха увеличивается раньше ревизий пользователей: см. TokenCache.set.
+        """
+        slots = [1] if user_ids is None else sorted({2 + user_id % self.slots for user_id in user_ids})
+        data = self._open()
+        with self._lock:
+            if self._fd is not None and fcntl is not None:
+                fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                for slot in [0] + slots:
+                    struct.pack_into('q', data, slot * 8, struct.unpack_from('q', data, slot * 8)[0] + 1)
+            finally:
+                if self._fd is not None and fcntl is not None:
+                    fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _read(self, slot):
+        return struct.unpack_from('q', self._open(), slot * 8)[0]
+
+    def _open(self):
+        data = self._map
+        if data is not None:
+            return data
+        size = (self.slots + 2) * 8
+        with self._lock:
+            if self._map is None:
+                if self.path is None:
+                    self._map = mmap.mmap(-1, size)
+                else:
+                    fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                    if os.fstat(fd).st_size < size:
+                        os.ftruncate(fd, size)
+                    self._map = mmap.mmap(fd, size)
+                    self._fd = fd
+            return self._map
+
+
+def token_revisions_path(config):
+    """ TOKEN_REVISIONS_PATH или файл рядом с базой; для базы в памяти - None. """
+    if config['TOKEN_REVISIONS_PATH']:
+        return config['TOKEN_REVISIONS_PATH']
+    if config['DATABASE_PATH'] == ':memory:':
+        return None
+    return config['DATABASE_PATH'] + '-tokens'
+
+
+class TokenCache(object):
+    """ Ограниченный LRU/TTL кэш проверенных токенов.
+
+    Хранит по токену найденного пользователя и срок действия токена,
+    чтобы повторная проверка токена не искала сессию в базе.
+
+    Вместе с пользователем запоминается его ревизия в revisions
+    (TokenRevisions): после отзыва его токенов в любом процессе запись
+    больше не отдается. Отзыв токенов одного пользователя не сбрасывает
+    записи остальных.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60, revisions=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.revisions = revisions if revisions is not None else TokenRevisions()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # token -> (user, deadline, expiration, revision)
+        self._user_tokens = {}  # user_id -> {token, ...}
+        self._lock = Lock()
+
+    def init_app(self, app):
+        self.maxsize = app.config['TOKEN_CACHE_SIZE']
+        self.ttl = app.config['TOKEN_CACHE_TTL']
+        self.revisions = TokenRevisions(token_revisions_path(app.config))
+        self.clear()
+        app.extensions['token_cache'] = self
+
+    def get(self, token):
+        """ Возвращает пользователя по токену или None. """
+        with self._lock:
+            entry = self._data.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            user, deadline, expiration, revision = entry
+            if deadline < monotonic() or expiration is not None and expiration <= time() \
+                    or revision != self.revisions.get(user.id):
+                self._remove(token)
+                self.misses += 1
+                return None
+
+            self._data.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def set(self, token, user, expiration=None, epoch=None):
+        """ Запоминает пользователя токена до истечения ttl или срока токена.
+
+        expiration - срок действия токена в unix time, epoch - эпоха
+        revisions, прочитанная до поиска сессии. Если с тех пор токены
+        кто-то отзывал, найденная сессия могла быть уже удалена, и значение
+        не сохраняется.
+        """
+        if self.maxsize <= 0:
+            return
+        # ревизия читается до эпохи: отзыв между ними изменит эпоху
+        revision = self.revisions.get(user.id)
+        if epoch is not None and self.revisions.epoch() != epoch:
+            return
+        with self._lock:
+            self._remove(token)
+            self._data[token] = (user, monotonic() + self.ttl, expiration, revision)
+            self._user_tokens.setdefault(user.id, set()).add(token)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def revoke(self, user_ids=None):
+        """ Отзыв токенов пользователей user_ids (None - всех) для кэшей всех процессов.
+
+        Вызывается после фиксации удаления сессий.
+        """
+        self.revisions.bump(user_ids)
+        if user_ids is None:
+            self.clear()
+            return
+        for user_id in user_ids:
+            self.invalidate_user(user_id)
+
+    def invalidate(self, token):
+        """ Удаляет токен из кэша. """
+        with self._lock:
+            self._remove(token)
+
+    def invalidate_user(self, user_id):
+        """ Удаляет из кэша все токены пользователя. """
+        with self._lock:
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._user_tokens.clear()
+
+    def stats(self):
+        """ Счетчики попаданий, промахов и вытеснений. """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits_total': self.hits,
+                'misses_total': self.misses,
+                'evictions_total': self.evictions
+            }
+
+    def _remove(self, token):
+        entry = self._data.pop(token, None)
+        if entry is None:
+            return
+        user_id = entry[0].id
+        tokens = self._user_tokens.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._user_tokens[user_id]
+
+
+CachedResponse = namedtuple('CachedResponse', 'body status mimetype etag')
+
+
+class MemoryResponseCache(object):
+    """ LRU кэш ответов в памяти процесса с инвалидацией по тегам.
+
+    Поколение (generation) растет при каждой инвалидации и очистке: ответ,
+    собранный до нее, не будет сохранен (см. set).
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # key -> (CachedResponse, tags)
+        self._tags = {}  # tag -> {key, ...}
+        self._generation = 0
+        self._lock = Lock()
+
+    def generation(self):
+        return self._generation
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, tags, generation):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._remove(key)
+            self._data[key] = (value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate(self, *tags):
+        """ Удаляет все ответы, помеченные любым из тегов. """
+        with self._lock:
+            self._generation += 1
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
+            self._tags.clear()
+
+    def close(self):
+        pass
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[1]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SqliteResponseCache(object):
+    """ Кэш ответов в файле SQLite, общий для нескольких процессов-воркеров.
+
+    Интерфейс совпадает с MemoryResponseCache. У каждого потока свое соединение.
+    Порядок вытеснения приблизительный: время доступа обновляется не чаще
+    раза в access_resolution секунд на ключ, поэтому попадание обычно только
+    читает файл и не берет блокировку записи.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS response_cache ('
+        'key TEXT PRIMARY KEY, body BLOB NOT NULL, status INTEGER NOT NULL, '
+        'mimetype TEXT, etag TEXT, accessed REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed)',
+        'CREATE TABLE IF NOT EXISTS response_cache_tag ('
+        'tag TEXT NOT NULL, key TEXT NOT NULL, PRIMARY KEY (tag, key)) WITHOUT ROWID',
+        'CREATE INDEX IF NOT EXISTS response_cache_tag_key ON response_cache_tag (key)',
+        'CREATE TABLE IF NOT EXISTS response_cache_generation (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO response_cache_generation (id, value) VALUES (1, 0)',
+    ]
+
+    def __init__(self, path, maxsize=10000, access_resolution=60):
+        self.path = path
+        self.maxsize = maxsize
+        self.access_resolution = access_resolution
+        self._local = local()
+
+    def generation(self):
+        return self._connection().execute('SELECT value FROM response_cache_generation').fetchone()[0]
+
+    def get(self, key):
+        conn = self._connection()
+        row = conn.execute('SELECT body, status, mimetype, etag, accessed FROM response_cache WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            return None
+        now = time()
+        if row[4] < now - self.access_resolution:
+            try:
+                conn.execute('UPDATE response_cache SET accessed = ? WHERE key = ?', (now, key))
+            except sqlite3.OperationalError:  # файл занят записью: обновится при следующем попадании
+                pass
+        return CachedResponse(*row[:4])
+
+    def set(self, key, value, tags, generation):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('SELECT value FROM response_cache_generation').fetchone()[0] != generation:
+                return
+            self._delete(conn, [key])
+            conn.execute('INSERT INTO response_cache (key, body, status, mimetype, etag, accessed) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', (key,) + tuple(value) + (time(),))
+            conn.executemany('INSERT INTO response_cache_tag (tag, key) VALUES (?, ?)',
+                             [(tag, key) for tag in tags])
+            excess = conn.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0] - self.maxsize
+            if excess > 0:
+                self._delete(conn, [row[0] for row in conn.execute(
+                    'SELECT key FROM response_cache ORDER BY accessed LIMIT ?', (excess,))])
+
+    def invalidate(self, *tags):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE response_cache_generation SET value = value + 1')
+            for tag in tags:
+                self._delete(conn, [row[0] for row in conn.execute(
+                    'SELECT key FROM response_cache_tag WHERE tag = ?', (tag,))])
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE response_cache_generation SET value = value + 1')
+            conn.execute('DELETE FROM response_cache')
+            conn.execute('DELETE FROM response_cache_tag')
+
+    def close(self):
+        """ Закрывает соединение текущего потока (например, после fork). """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = wal')
+            conn.execute('PRAGMA synchronous = normal')
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _delete(conn, keys):
+        for key in keys:
+            conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            conn.execute('DELETE FROM response_cache_tag WHERE key = ?', (key,))
+
+
+def make_response_cache(config):
+    """ Кэш ответов по RESPONSE_CACHE_BACKEND: 'memory', 'sqlite' или None (выключен). """
+    backend = config['RESPONSE_CACHE_BACKEND']
+    if backend == 'memory':
+        return MemoryResponseCache(config['RESPONSE_CACHE_SIZE'])
+    if backend == 'sqlite':
+        return SqliteResponseCache(config['RESPONSE_CACHE_PATH'], config['RESPONSE_CACHE_SIZE'],
+                                   config['RESPONSE_CACHE_ACCESS_RESOLUTION'])
+    return None
@@ -0,0 +1,57 @@
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from app import db
+from app.migrations import MigrationError, migrate
+from app.models import User
+
+
+@click.command('migrate')
+@with_appcontext
+def migrate_command():
+    """ Создает недостающие таблицы и применяет миграции к data.db. """
+    try:
+        migrate(db)
+    except MigrationError as e:
+        raise click.ClickException(str(e))
+    click.echo('Database migrated.')
+
+
+@click.command('sweep-tokens')
+@with_appcontext
+def sweep_tokens_command():
+    """ Очищает истекшие токены. """
+    with db.connection_context():
+        cleared = User.clear_expired_tokens(current_app.config['TOKEN_SWEEP_BATCH_SIZE'])
+    click.echo(f'Expired tokens cleared: {cleared}.')
+
+
+@click.command('revoke-tokens')
+@with_appcontext
+@click.argument('ids', nargs=-1, type=int)
+@click.option('--all', 'revoke_all', is_flag=True, help='Отозвать токены всех пользователей.')
+def revoke_tokens_command(ids, revoke_all):
+    """ Отзывает токены пользователей с указанными id (или всех с --all). """
+    if not ids and not revoke_all:
+        raise click.UsageError('Pass user ids or --all.')
+    with db.connection_context():
+        revoked = User.revoke_tokens(None if revoke_all else list(ids))
+    click.echo(f'Tokens revoked: {revoked}.')
+
+
+@click.command('set-admin')
+@with_appcontext
+@click.argument('username')
+@click.option('--revoke', is_flag=True, help='Снять права администратора.')
+def set_admin_command(username, revoke):
+    """ Выдает (или снимает) права администратора. """
+    with db.connection_context():
+        updated = User.update(admin=not revoke).where(User.username == username).execute()
+    if not updated:
+        raise click.ClickException(f'User {username} not found.')
+    click.echo(f'User {username} updated.')
+
+
+def init_app(app):
+    for command in [migrate_command, sweep_tokens_command, revoke_tokens_command, set_admin_command]:
+        app.cli.add_command(command)
@@ -0,0 +1,70 @@
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS
+
+
+class DefaultConfig(object):
+    """ Значения по умолчанию; create_app загружает их до настроек экземпляра (config.py). """
+
+    USERS_PER_PAGE = 100
+    USERS_MAX_PER_PAGE = 1000
+    USERS_STREAM_CHUNK_SIZE = 500
+    TOKEN_CACHE_SIZE = 10000
+    # отзыв токенов приложением (API, flask revoke-tokens) виден всем процессам сразу,
+    # сессии, удаленные в базе в обход приложения, - не позже чем через столько секунд
+    TOKEN_CACHE_TTL = 60
+    # файл общих для процессов ревизий отзыва токенов; None - DATABASE_PATH + '-tokens'
+    TOKEN_REVISIONS_PATH = None
+    USERS_BATCH_MAX_SIZE = 5000
+    USERS_BATCH_CHUNK_SIZE = 200
+    # более короткий префикс совпадает со слишком большой долей таблицы для ранжирования
+    USERS_SEARCH_MIN_LENGTH = 2
+    # подзапросов в одном POST /api/batch (каждый выполняется в своей транзакции)
+    BATCH_MAX_REQUESTS = 20
+    # потоков хэширования паролей на процесс; 0 - половина ядер, поделенная между SERVER_WORKERS
+    PASSWORD_HASH_WORKERS = 0
+    # потоков для паролей POST /users/batch: отдельный пул, пачки хэшируются по одной;
+    # 0 - столько же, сколько для входа, т.е. пачка параллельно с входом занимает
+    # до всех ядер процесса (1 - меньше нагрузки на вход, но пачка хэшируется последовательно)
+    PASSWORD_HASH_BATCH_WORKERS = 0
+    # число процессов сервера (app.server задает его из --workers)
+    SERVER_WORKERS = 1
+    DATABASE_PATH = 'data.db'
+    # > 0 - пул соединений вместо соединения на запрос
+    DATABASE_MAX_CONNECTIONS = 0
+    DATABASE_STALE_TIMEOUT = 300
+    # > 0 - SELECT вне транзакций идут через пул соединений только для чтения такого размера
+    DATABASE_READ_CONNECTIONS = 4
+    DATABASE_PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',  # в режиме WAL fsync только при checkpoint
+        'cache_size': -64 * 1024,  # 64 МБ
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000,  # мс ожидания блокировки вместо "database is locked"
+    }
+    # воркеры app.server пишут в свои файлы рядом: logs/app-0.log, logs/app-1.log, ...
+    LOG_FILE = 'logs/app.log'
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUP_COUNT = 5
+    # доля успешных запросов, попадающих в лог (ошибки пишутся всегда)
+    LOG_SAMPLE_RATE = 1.0
+    # максимальный размер тела запроса/ответа в записи лога, байт
+    LOG_PAYLOAD_LIMIT = 1024
+    # метрики в памяти процесса: у каждого воркера app.server свои
+    METRICS_ENABLED = False
+    # 'memory' - в памяти процесса (app.server с несколькими воркерами заменяет его на 'sqlite'),
+    # 'sqlite' - общий для воркеров файл RESPONSE_CACHE_PATH, None - выключен
+    RESPONSE_CACHE_BACKEND = 'memory'
+    RESPONSE_CACHE_SIZE = 10000
+    RESPONSE_CACHE_PATH = 'cache.db'
+    # 'sqlite': время доступа для LRU обновляется не чаще раза в столько секунд на ключ
+    RESPONSE_CACHE_ACCESS_RESOLUTION = 60
+    # при входе пересчитываются только более слабые хэши (меньше итераций, короче дайджест);
+    # итераций не меньше, чем по умолчанию у установленного Werkzeug
+    PASSWORD_HASH_METHOD = f'pbkdf2:sha256:{max(260000, DEFAULT_PBKDF2_ITERATIONS)}'
+    PASSWORD_SALT_LENGTH = 16
+    # сверх PASSWORD_HASH_WORKERS выполняемых задач - не больше стольких ожидающих, иначе 503
+    PASSWORD_HASH_QUEUE_SIZE = 32
+    CONFIRM_TOKEN_MAX_AGE = 7 * 24 * 3600
+    # период фоновой очистки истекших токенов, секунды (0 - выключена); поток запускается
+    # при первом запросе обслуживающего процесса (в app.server - только в воркере 0)
+    TOKEN_SWEEP_INTERVAL = 600
+    TOKEN_SWEEP_BATCH_SIZE = 1000
@@ -0,0 +1,42 @@
+""" Кодирование ответов API в JSON.
+
+Используется orjson, если он установлен, иначе json из стандартной
+библиотеки. Даты кодируются так же, как в jsonify Flask (HTTP-дата).
+"""
+import json
+from datetime import date, datetime
+from flask import current_app
+
+try:
+    import orjson
+except ImportError:  # необязательная зависимость
+    orjson = None
+
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+def encode_default(value):
+    # то же, что werkzeug.http.http_date, без перевода через timetuple и strftime
+    if isinstance(value, datetime):
+        return (f'{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} '
+                f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT')
+    if isinstance(value, date):
+        return f'{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} 00:00:00 GMT'
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(data):
+        """ Возвращает JSON в виде bytes. """
+        return orjson.dumps(data, default=encode_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+else:
+    def dumps(data):
+        """ Возвращает JSON в виде bytes. """
+        return json.dumps(data, default=encode_default, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(data, status=200):
+    """ Замена jsonify на быстром кодировщике. """
+    return current_app.response_class(dumps(data), status=status, mimetype='application/json')
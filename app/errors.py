@@ -1,15 +1,27 @@
-from app import app
-from flask import make_response, jsonify
+from flask import current_app
+from app.metrics import metrics
+from app.encoding import dumps
+from app.hashing import HashingBusyError
 # from app.api.errors import error_response as api_error_response
 import app.api.errors as apiErr
 
 
-@app.errorhandler(Exception)
+INTERNAL_ERROR_BODY = dumps({
+    'message': 'Internal error',
+    'code': -1
+})
+
+
 def api_error(error):
+    if isinstance(error, HashingBusyError):
+        error = apiErr.BusyError()
     if isinstance(error, apiErr.ApiError):
+        metrics.inc('api_errors_total', (('code', str(error.api_code)),))
         return error.make_response()
 
-    return make_response(jsonify({
-        'message': 'Internal error',
-        'code': -1
-    }), 500)
+    metrics.inc('api_errors_total', (('code', '-1'),))
+    return current_app.response_class(INTERNAL_ERROR_BODY, status=500, mimetype='application/json')
+
+
+def init_app(app):
+    app.register_error_handler(Exception, api_error)
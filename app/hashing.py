@@ -0,0 +1,150 @@
+import hashlib
+import os
+from app.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import BoundedSemaphore, Lock
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash, check_password_hash
+
+
+class HashingBusyError(Exception):
+    """ Очередь хэширования паролей переполнена. """
+
+
+class PasswordHasher(object):
+    """ Пулы потоков для хэширования паролей одного приложения (создаются при первом обращении).
+
+    PBKDF2 из hashlib отпускает GIL, поэтому хэши считаются параллельно,
+    а число потоков ограничивает долю CPU, которую может занять вход.
+    """
+
+    def __init__(self, config):
+        # половина ядер, поделенная между процессами сервера
+        default_workers = max(1, (os.cpu_count() or 1) // 2 // config['SERVER_WORKERS'])
+        self.workers = config['PASSWORD_HASH_WORKERS'] or default_workers
+        self.queue_size = config['PASSWORD_HASH_QUEUE_SIZE']
+        self.batch_workers = config['PASSWORD_HASH_BATCH_WORKERS'] or default_workers
+        self.method = config['PASSWORD_HASH_METHOD']
+        self.salt_length = config['PASSWORD_SALT_LENGTH']
+        self._executor = None
+        self._slots = None
+        self._batch_executor = None
+        self._batch_slot = None
+        self._lock = Lock()
+        self._stats = {'in_flight': 0, 'rejected': 0}
+
+    def get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+                self._slots = BoundedSemaphore(self.workers + self.queue_size)
+            return self._executor
+
+    def get_batch_executor(self):
+        """ Отдельный пул для пакетной регистрации: пачка не встает в очередь перед входом. """
+        with self._lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_workers,
+                                                          thread_name_prefix='password-hash-batch')
+                self._batch_slot = BoundedSemaphore(1)
+            return self._batch_executor
+
+    def run(self, func, *args):
+        """ Выполняет func в пуле и ждет результат.
+
+        Если выполняется и ждет в очереди больше PASSWORD_HASH_WORKERS +
+        PASSWORD_HASH_QUEUE_SIZE задач, сразу выбрасывает HashingBusyError.
+        """
+        executor = self.get_executor()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HashingBusyError()
+        with self._lock:
+            self._stats['in_flight'] += 1
+        try:
+            return executor.submit(func, *args).result()
+        finally:
+            with self._lock:
+                self._stats['in_flight'] -= 1
+            self._slots.release()
+
+    def hash_password(self, password):
+        return self.run(partial(generate_password_hash, password,
+                                method=self.method, salt_length=self.salt_length))
+
+    def check_password(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """ Хэш слабее текущих настроек: не PBKDF2, меньше итераций, короче дайджест или соль.
+
+        Более стойкий хэш (например, от новой версии Werkzeug с большим числом
+        итераций) не пересчитывается: вход не должен его ослаблять.
+        """
+        if password_hash.count('$') < 2:
+            return True
+        method, salt, _ = password_hash.split('$', 2)
+        if len(salt) < self.salt_length:
+            return True
+        return any(stored < current for stored, current
+                   in zip(method_strength(method), method_strength(self.method)))
+
+    def hash_passwords(self, passwords):
+        """ Возвращает хэши паролей в исходном порядке.
+
+        Пачки считаются в пуле get_batch_executor по одной: пока хэшируется
+        пачка, следующая сразу получает HashingBusyError.
+        """
+        executor = self.get_batch_executor()
+        if not self._batch_slot.acquire(blocking=False):
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise HashingBusyError()
+        hash_one = partial(generate_password_hash, method=self.method, salt_length=self.salt_length)
+        try:
+            with metrics.timer('api_password_hash_seconds', (('op', 'batch'),)):
+                return list(executor.map(hash_one, passwords))
+        finally:
+            self._batch_slot.release()
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': self._stats['in_flight'], 'rejected_total': self._stats['rejected']}
+
+
+def method_strength(method):
+    """ (PBKDF2 ли, размер дайджеста, число итераций) для метода Werkzeug вида pbkdf2:sha256:260000. """
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2':  # соленый дайджест без растяжения ключа
+        return 0, 0, 0
+    digest = parts[1] if len(parts) > 1 and parts[1] else 'sha256'
+    iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_PBKDF2_ITERATIONS
+    return 1, hashlib.new(digest).digest_size, iterations
+
+
+def init_app(app):
+    """ Создает хэшер приложения; после fork - заново (потоки пула в дочернем процессе не существуют). """
+    hasher = app.extensions['password_hasher'] = PasswordHasher(app.config)
+    app.extensions['metrics'].add_collector('api_password_hash', hasher.stats)
+
+
+def get_hasher():
+    return current_app.extensions['password_hasher']
+
+
+def hash_password(password):
+    return get_hasher().hash_password(password)
+
+
+def check_password(password_hash, password):
+    return get_hasher().check_password(password_hash, password)
+
+
+def needs_rehash(password_hash):
+    return get_hasher().needs_rehash(password_hash)
+
+
+def hash_passwords(passwords):
+    return get_hasher().hash_passwords(passwords)
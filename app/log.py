@@ -0,0 +1,78 @@
+import atexit
+import json
+import os
+from logging import Formatter, INFO
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Queue
+from flask.logging import default_handler
+
+
+class JsonLinesFormatter(Formatter):
+    """ Форматирует запись в одну строку JSON.
+
+    Словарь из record.msg становится полями записи, bytes декодируются.
+    """
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'level': record.levelname}
+        if isinstance(record.msg, dict):
+            data.update(record.msg)
+        else:
+            data['message'] = record.getMessage()
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=self.encode_default, ensure_ascii=False)
+
+    @staticmethod
+    def encode_default(value):
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return str(value)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """ Кладет запись в очередь как есть: форматирование выполняется в фоновом потоке. """
+
+    def prepare(self, record):
+        return record
+
+
+def log_file(app, worker_id=None):
+    """ LOG_FILE или, для воркера prefork-сервера, свой файл воркера рядом с ним (app-1.log).
+
+    Ротация одного файла несколькими процессами теряет и портит записи.
+    """
+    if worker_id is None:
+        return app.config['LOG_FILE']
+    root, ext = os.path.splitext(app.config['LOG_FILE'])
+    return f'{root}-{worker_id}{ext}'
+
+
+def setup_logging(app, worker_id=None):
+    """ Подключает к app.logger запись в файл через очередь и фоновый поток.
+
+    При повторном вызове (в воркере после fork, с worker_id) заменяет очередь,
+    поток и файловый обработчик. Файл открывается при первой записи.
+    """
+    for handler in [handler for handler in app.logger.handlers if isinstance(handler, DeferredQueueHandler)]:
+        app.logger.removeHandler(handler)
+    previous = app.extensions.get('log_listener')
+    if previous is not None:
+        atexit.unregister(previous.stop)
+    file_handler = RotatingFileHandler(log_file(app, worker_id),
+                                       maxBytes=app.config['LOG_MAX_BYTES'],
+                                       backupCount=app.config['LOG_BACKUP_COUNT'],
+                                       delay=True)
+    file_handler.setFormatter(JsonLinesFormatter())
+    file_handler.setLevel(INFO)
+
+    log_queue = Queue()
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    app.logger.setLevel(INFO)
+    # стандартный обработчик Flask пишет в stderr синхронно, в потоке запроса
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(DeferredQueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
+    app.extensions['log_listener'] = listener
+    return listener
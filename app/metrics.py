@@ -0,0 +1,148 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import perf_counter
+from flask import current_app, g, has_app_context, has_request_context, request
+from werkzeug.local import LocalProxy
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics(object):
+    """ Счетчики и гистограммы приложения в памяти процесса в формате Prometheus.
+
+    Пока enabled == False, все методы сразу возвращаются.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = {}  # name -> collect
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED']
+        app.extensions['metrics'] = self
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    def add_collector(self, name, collect):
+        """ collect() возвращает словарь показателей, они выводятся как name_<ключ>.
+
+        Ключи с суффиксом _total экспортируются как counter, остальные как gauge.
+        Повторная регистрация с тем же именем заменяет прежнюю.
+        """
+        self._collectors[name] = collect
+
+    def inc(self, name, labels=(), value=1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        if not self.enabled:
+            yield
+            return
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, perf_counter() - start)
+
+    def observe_query(self, seconds):
+        endpoint = request.endpoint if has_request_context() else None
+        labels = (('endpoint', endpoint or ''),)
+        self.inc('api_db_queries_total', labels)
+        self.inc('api_db_query_seconds_total', labels, seconds)
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """ Текстовый формат экспозиции Prometheus. """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            for bound, count in zip(BUCKETS, histogram):
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{format_labels(labels + (("le", "+Inf"),))} {histogram[-1]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{format_labels(labels)} {histogram[-1]}')
+
+        for prefix, collect in sorted(self._collectors.items()):
+            for key, value in sorted(collect().items()):
+                kind = 'counter' if key.endswith('_total') else 'gauge'
+                lines.append(f'# TYPE {prefix}_{key} {kind}')
+                lines.append(f'{prefix}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def _start_request(self):
+        if self.enabled:
+            g.metrics_start = perf_counter()
+
+    def _end_request(self, response):
+        if self.enabled and 'metrics_start' in g:
+            self.observe('api_request_duration_seconds', (
+                ('endpoint', request.endpoint or ''),
+                ('method', request.method),
+                ('status', str(response.status_code))
+            ), perf_counter() - g.metrics_start)
+        return response
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# метрики вне контекста приложения (скрипты, фоновые потоки без контекста) не собираются
+disabled_metrics = Metrics()
+# метрики текущего приложения (app.extensions['metrics'])
+metrics = LocalProxy(lambda: current_app.extensions['metrics'] if has_app_context() else disabled_metrics)
+
+
+class InstrumentedDatabaseMixin(object):
+    """ Считает количество и время SQL-запросов. """
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if not metrics.enabled:
+            return super().execute_sql(sql, *args, **kwargs)
+        start = perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            metrics.observe_query(perf_counter() - start)
+
@@ -0,0 +1,133 @@
+from time import time
+from app import db
+from app.models import User, TableVersion, Session, USER_TRIGGER_NAMES
+from peewee import chunked
+from playhouse.migrate import SqliteMigrator, migrate as run_operations
+
+MODELS = [User, TableVersion, Session]
+
+
+class MigrationError(Exception):
+    """ Миграцию нельзя применить без исправления данных вручную. """
+
+
+def token_expiration_to_epoch(database):
+    """ Переводит token_expiration из строки '%Y-%m-%d %H:%M:%S' (UTC) в unix time. """
+    if 'token_expiration' not in [column.name for column in database.get_columns('user')]:
+        return
+    database.execute_sql(
+        'UPDATE "user" SET token_expiration = CAST(strftime(\'%s\', token_expiration) AS INTEGER) '
+        'WHERE typeof(token_expiration) = \'text\'')
+
+
+def add_user_version(database):
+    """ Добавляет версию строки пользователя (для ETag). """
+    if 'version' not in [column.name for column in database.get_columns('user')]:
+        run_operations(SqliteMigrator(database).add_column('user', 'version', User.version))
+
+
+def add_user_admin(database):
+    """ Добавляет флаг администратора. """
+    if 'admin' not in [column.name for column in database.get_columns('user')]:
+        run_operations(SqliteMigrator(database).add_column('user', 'admin', User.admin))
+
+
+def add_user_change_feed(database):
+    """ Добавляет created_at/updated_at и курсор ленты изменений change_seq.
+
+    Существующим строкам курсоры раздаются по id после текущей версии таблицы,
+    триггеры пересоздаются в create_tables.
+    """
+    columns = [column.name for column in database.get_columns('user')]
+    if 'change_seq' in columns:
+        return
+    migrator = SqliteMigrator(database)
+    run_operations(
+        migrator.add_column('user', 'created_at', User.created_at),
+        migrator.add_column('user', 'updated_at', User.updated_at),
+        migrator.add_column('user', 'change_seq', User.change_seq),
+    )
+    for name in USER_TRIGGER_NAMES:
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.create_tables([TableVersion], safe=True)
+    database.execute_sql("INSERT OR IGNORE INTO table_version (name, version) VALUES ('user', 0)")
+    database.execute_sql(
+        'UPDATE "user" SET change_seq = id + '
+        '(SELECT version FROM table_version WHERE name = \'user\')')
+    database.execute_sql(
+        'UPDATE table_version SET version = version + '
+        '(SELECT COALESCE(MAX(id), 0) FROM "user") WHERE name = \'user\'')
+
+
+def move_tokens_to_sessions(database):
+    """ Переносит действующие токены из user.token в таблицу session и удаляет столбцы токена. """
+    if 'token' not in [column.name for column in database.get_columns('user')]:
+        return
+    rows = database.execute_sql('SELECT id, token, token_expiration FROM "user" '
+                                'WHERE token IS NOT NULL AND token_expiration > ?', (int(time()),)).fetchall()
+    migrator = SqliteMigrator(database)
+    run_operations(migrator.drop_column('user', 'token'), migrator.drop_column('user', 'token_expiration'))
+    database.create_tables([Session], safe=True)
+    for chunk in chunked(rows, 200):
+        Session.insert_many([{
+            'token_hash': Session.hash_token(token),
+            'user': id,
+            'expires_at': expiration
+        } for id, token, expiration in chunk]).execute(database)
+
+
+def drop_session_revision_triggers(database):
+    """ Удаляет триггеры общей ревизии отзывов в table_version.
+
+    Отзыв токенов теперь отмечается в TokenRevisions (app/cache.py) без
+    запроса к базе при проверке токена; user_after_delete без этой ревизии
+    пересоздается в create_tables.
+    """
+    triggers = [row[0] for row in database.execute_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' "
+        "AND name IN ('session_after_delete', 'user_after_admin_update')")]
+    if not triggers:
+        return
+    for name in triggers + ['user_after_delete']:
+        database.execute_sql(f'DROP TRIGGER IF EXISTS {name}')
+    database.execute_sql("DELETE FROM table_version WHERE name = 'session'")
+
+
+def check_unique_users(database):
+    """ Проверяет, что уникальные индексы username/email, создаваемые в create_tables, можно создать.
+
+    Иначе миграция откатилась бы с IntegrityError без указания повторов.
+    """
+    indexes = database.get_indexes('user')
+    for column in ('username', 'email'):
+        if any(index.unique and index.columns == [column] for index in indexes):
+            continue
+        rows = database.execute_sql(
+            f'SELECT {column}, COUNT(*) FROM "user" WHERE {column} IS NOT NULL '
+            f'GROUP BY {column} HAVING COUNT(*) > 1 ORDER BY {column} LIMIT 10').fetchall()
+        if rows:
+            values = ', '.join(f'{value!r} ({count})' for value, count in rows)
+            raise MigrationError(f'Duplicate user.{column} values prevent creating a unique index: {values}. '
+                                 'Rename or remove the duplicates and run the migration again.')
+
+
+# Миграции применяются к уже существующей таблице user при каждом запуске,
+# поэтому должны быть идемпотентными.
+MIGRATIONS = [
+    token_expiration_to_epoch,
+    add_user_version,
+    add_user_admin,
+    add_user_change_feed,
+    move_tokens_to_sessions,
+    drop_session_revision_triggers,
+    check_unique_users,
+]
+
+
+def migrate(database=db):
+    """ Применяет миграции и создает недостающие таблицы, индексы и триггеры. """
+    with database.atomic():
+        if 'user' in database.get_tables():
+            for migration in MIGRATIONS:
+                migration(database)
+        database.create_tables(MODELS, safe=True)
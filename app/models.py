@@ -1,33 +1,163 @@
 import os
 import base64
-from app import db
+import hashlib
+from app import db, token_cache
+from app.metrics import metrics
+from app import hashing
 import peewee as pw
-from datetime import datetime, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
+from functools import partial
+from time import time
+
+
+# Видимые в API изменения пользователя увеличивают версию строки (user.version)
+# и версию таблицы (table_version), по которым строятся ETag. Новая версия таблицы
+# записывается в user.change_seq - монотонный курсор ленты изменений.
+USER_CHANGED = ('OLD.username IS NOT NEW.username OR OLD.email IS NOT NEW.email OR '
+                'OLD.birthday IS NOT NEW.birthday OR OLD.confirmed IS NOT NEW.confirmed')
+BUMP_TABLE_VERSION = ("INSERT OR IGNORE INTO table_version (name, version) VALUES ('user', 0); "
+                      "UPDATE table_version SET version = version + 1 WHERE name = 'user';")
+CHANGE_SEQ = "(SELECT version FROM table_version WHERE name = 'user')"
+USER_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS user_after_insert AFTER INSERT ON "user" '
+    f'BEGIN {BUMP_TABLE_VERSION} '
+    f'UPDATE "user" SET change_seq = {CHANGE_SEQ} WHERE id = NEW.id; END',
+    'CREATE TRIGGER IF NOT EXISTS user_after_update AFTER UPDATE ON "user" '
+    f'WHEN {USER_CHANGED} '
+    f'BEGIN {BUMP_TABLE_VERSION} '
+    'UPDATE "user" SET version = OLD.version + 1, updated_at = CAST(strftime(\'%s\', \'now\') AS INTEGER), '
+    f'change_seq = {CHANGE_SEQ} WHERE id = NEW.id; END',
+    'CREATE TRIGGER IF NOT EXISTS user_after_delete AFTER DELETE ON "user" '
+    f'BEGIN {BUMP_TABLE_VERSION} END',
+]
+USER_TRIGGER_NAMES = ['user_after_insert', 'user_after_update', 'user_after_delete']
+
+# Поиск по началу username: FTS5 с внешним содержимым (строки берутся из user),
+# синхронизируется триггерами. '_.@-+' входят в токен, поэтому username и email
+# индексируются целиком, а префиксные индексы ускоряют короткие запросы. Email
+# ищется только целиком, по уникальному индексу (см. User.search).
+USER_SEARCH_TABLE = ('CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5('
+                     'username, email, content=\'user\', content_rowid=\'id\', '
+                     'tokenize="unicode61 tokenchars \'_.@-+\'", prefix=\'2 3 4\')')
+SEARCH_INSERT = 'INSERT INTO user_search (rowid, username, email) VALUES (NEW.id, NEW.username, NEW.email);'
+SEARCH_DELETE = ("INSERT INTO user_search (user_search, rowid, username, email) "
+                 "VALUES ('delete', OLD.id, OLD.username, OLD.email);")
+USER_SEARCH_TRIGGERS = [
+    'CREATE TRIGGER IF NOT EXISTS user_search_after_insert AFTER INSERT ON "user" '
+    f'BEGIN {SEARCH_INSERT} END',
+    'CREATE TRIGGER IF NOT EXISTS user_search_after_update AFTER UPDATE OF username, email ON "user" '
+    'WHEN OLD.username IS NOT NEW.username OR OLD.email IS NOT NEW.email '
+    f'BEGIN {SEARCH_DELETE} {SEARCH_INSERT} END',
+    'CREATE TRIGGER IF NOT EXISTS user_search_after_delete AFTER DELETE ON "user" '
+    f'BEGIN {SEARCH_DELETE} END',
+]
+
+
+def now():
+    return int(time())
+
+
+class TableVersion(pw.Model):
+    """ Версия таблицы, поддерживается триггерами. """
+
+    class Meta:
+        database = db
+        table_name = 'table_version'
+
+    name = pw.CharField(64, primary_key=True)
+    version = pw.IntegerField(default=0)
+
+    @staticmethod
+    def get_version(name):
+        return TableVersion.select(TableVersion.version).where(TableVersion.name == name).scalar() or 0
 
 
 class User(pw.Model):
     class Meta:
         database = db
+        # UPDATE пишет только измененные поля, без изменений save() ничего не пишет
+        only_save_dirty = True
 
-    username = pw.CharField(64)  # , null=False
-    email = pw.CharField(128)
+    username = pw.CharField(64, unique=True)  # , null=False
+    email = pw.CharField(128, unique=True)
     birthday = pw.DateField(formats='%Y-%m-%d', null=True)
     password_hash = pw.CharField(128)
     confirmed = pw.BooleanField(default=False)
-    token = pw.CharField(32, index=True, unique=True, null=True)
-    token_expiration = pw.DateField(formats='%Y-%m-%d %H:%M:%S', null=True)
+    version = pw.IntegerField(default=1)
+    admin = pw.BooleanField(default=False)
+    created_at = pw.IntegerField(default=now)  # unix time
+    updated_at = pw.IntegerField(default=now)  # unix time, обновляет триггер
+    change_seq = pw.IntegerField(index=True, null=True)  # заполняет триггер
+
+    # поля, которые можно запросить через fields=: в коллекции и у своей учетной записи
+    PUBLIC_FIELDS = ('id', 'birthday', 'username', 'confirmed')
+    PRIVATE_FIELDS = PUBLIC_FIELDS + ('email',)
+    TRIGGER_FIELDS = ('version', 'updated_at', 'change_seq')
+
+    @classmethod
+    def create_table(cls, safe=True, **options):
+        super().create_table(safe=safe, **options)
+        for sql in USER_TRIGGERS:
+            cls._meta.database.execute_sql(sql)
+        cls.create_search_index()
+
+    @classmethod
+    def drop_table(cls, safe=True, **options):
+        cls._meta.database.execute_sql('DROP TABLE IF EXISTS user_search')
+        super().drop_table(safe=safe, **options)
+
+    @classmethod
+    def create_search_index(cls):
+        """ Создает индекс user_search и его триггеры, если SQLite собран с FTS5.
+
+        Миграция, пересоздающая таблицу user (drop_column), удаляет ее
+        триггеры, поэтому недостающие триггеры создаются заново, а индекс,
+        пропустивший изменения без них, перестраивается.
+        """
+        database = cls._meta.database
+        cursor = database.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'user' "
+            "AND name LIKE 'user_search_%'")
+        triggers = {row[0] for row in cursor.fetchall()}
+        if 'user_search' in database.get_tables() and len(triggers) == len(USER_SEARCH_TRIGGERS):
+            return
+        try:
+            database.execute_sql(USER_SEARCH_TABLE)
+        except pw.OperationalError:  # нет FTS5: поиск по индексам username и email
+            return
+        for sql in USER_SEARCH_TRIGGERS:
+            database.execute_sql(sql)
+        database.execute_sql("INSERT INTO user_search (user_search) VALUES ('rebuild')")
+
+    def save(self, force_insert=False, only=None):
+        # эти поля меняет только триггер: устаревший экземпляр не должен их откатить
+        if self.id is not None and not force_insert:
+            self._dirty.difference_update(User.TRIGGER_FIELDS)
+        return super().save(force_insert=force_insert, only=only)
+
+    @staticmethod
+    def select_fields(fields, *columns):
+        """ select() только столбцов с именами fields и столбцов columns. """
+        names = {column.name for column in columns}
+        return User.select(*columns, *[User._meta.fields[field] for field in fields if field not in names])
+
+    def get_etag(self):
+        return f'user-{self.id}-{self.version}'
 
     def get_confirmed(self):
         return self.confirmed
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        with metrics.timer('api_password_hash_seconds', (('op', 'set'),)):
+            self.password_hash = hashing.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        with metrics.timer('api_password_hash_seconds', (('op', 'check'),)):
+            return hashing.check_password(self.password_hash, password)
 
-    def to_dict(self, include_email=False):
+    def password_needs_rehash(self):
+        return hashing.needs_rehash(self.password_hash)
+
+    def to_dict(self, include_email=False, fields=None):
         data = {
             'id': self.id,
             'birthday': self.birthday,
@@ -36,47 +166,226 @@ class User(pw.Model):
         }
         if include_email:
             data['email'] = self.email
+        if fields is not None:
+            data = {field: data[field] for field in fields}
         return data
 
     def from_dict(self, data, new_user=False):
+        # неизмененные значения не присваиваются, чтобы не попасть в UPDATE
         for field in ['username', 'birthday', 'email']:
-            if field in data:
+            if field in data and self._meta.fields[field].python_value(data[field]) != getattr(self, field):
                 setattr(self, field, data[field])
         if new_user and 'password' in data:  # МБ лишнее
             self.set_password(data['password'])
 
     def get_token(self, expires_in=3600):
-        now = datetime.utcnow()
-        if self.token_expiration is not None:
-            time_token_expiration = datetime.strptime(self.token_expiration, '%Y-%m-%d %H:%M:%S')
-            if self.token and time_token_expiration > now + timedelta(seconds=60):
-                return self.token
-        self.token = base64.b64encode(os.urandom(24)).decode('utf-8')
-        self.token_expiration = (now + timedelta(seconds=expires_in)).strftime('%Y-%m-%d %H:%M:%S')
-        self.save()
-        return self.token
-
-    def revoke_token(self):
-        self.token_expiration = (datetime.utcnow() - timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
-        self.save()
+        """ Открывает новую сессию и возвращает ее токен (у пользователя может быть несколько сессий). """
+        token = base64.b64encode(os.urandom(24)).decode('utf-8')
+        Session.insert(token_hash=Session.hash_token(token), user=self.id,
+                       expires_at=int(time()) + expires_in).execute()
+        return token
+
+    def revoke_token(self, token=None):
+        """ Закрывает сессию с токеном token или, без него, все сессии пользователя. """
+        if token is None:
+            User.revoke_tokens([self.id])
+            return
+        Session.delete().where((Session.token_hash == Session.hash_token(token)) &
+                               (Session.user == self.id)).execute()
+        token_cache.invalidate(token)
+        Session._meta.database.after_commit(partial(token_cache.revoke, [self.id]))
 
     @staticmethod
     def check_token(token):
-        user = User.get_or_none(User.token == token)
-        if user is None:
+        user = token_cache.get(token)
+        if user is not None:
+            return user
+
+        # эпоха читается до сессии: отзыв после чтения не даст закэшировать удаленную сессию
+        epoch = token_cache.revisions.epoch()
+
+        session = (Session
+                   .select(Session.expires_at, User)
+                   .join(User)
+                   .where((Session.token_hash == Session.hash_token(token)) &
+                          (Session.expires_at > int(time())))
+                   .first())
+        if session is None:
             return None
-        if user.token_expiration is not None:
-            time_token_expiration = datetime.strptime(user.token_expiration, '%Y-%m-%d %H:%M:%S')
-            if time_token_expiration < datetime.utcnow():
-                return None
-        return user
+        token_cache.set(token, session.user, session.expires_at, epoch)
+        return session.user
+
+    @staticmethod
+    def clear_expired_tokens(batch_size=1000):
+        """ Удаляет истекшие сессии пачками DELETE, каждая в своей транзакции.
+
+        Возвращает число удаленных сессий.
+        """
+        total = 0
+        while True:
+            with Session._meta.database.atomic():
+                expired = (Session
+                           .select(Session.id)
+                           .where(Session.expires_at <= int(time()))
+                           .limit(batch_size))
+                cleared = Session.delete().where(Session.id.in_(expired)).execute()
+            total += cleared
+            if cleared < batch_size:
+                return total
+
+    @staticmethod
+    def revoke_tokens(ids=None):
+        """ Закрывает сессии всех пользователей (или из ids) одним DELETE. """
+        query = Session.delete()
+        if ids is not None:
+            query = query.where(Session.user.in_(ids))
+        revoked = query.execute()
+        Session._meta.database.after_commit(partial(token_cache.revoke, ids))
+        return revoked
+
+    @staticmethod
+    def confirm(id):
+        """ Подтверждает email одним UPDATE.
+
+        Возвращает False, если пользователя нет или он уже подтвержден.
+        """
+        return User.update(confirmed=True).where((User.id == id) & (User.confirmed == False)).execute() == 1
+
+    @staticmethod
+    def get_many(ids, fields=None):
+        """ Возвращает словарь id -> User для найденных пользователей.
+
+        fields - читаемые из базы поля (по умолчанию PRIVATE_FIELDS).
+        """
+        query = User.select_fields(fields or User.PRIVATE_FIELDS, User.id).where(User.id.in_(ids))
+        return {user.id: user for user in query}
+
+    @staticmethod
+    def to_collection_dict(limit, cursor=None, fields=None):
+        """ Возвращает страницу коллекции пользователей (keyset по id).
+
+        Из базы читаются только fields (по умолчанию PUBLIC_FIELDS) и id.
+        """
+        query = (User
+                 .select_fields(fields or User.PUBLIC_FIELDS, User.id)
+                 .order_by(User.id)
+                 .limit(limit + 1))
+        if cursor is not None:
+            query = query.where(User.id > cursor)
+
+        users = list(query)
+        next_cursor = None
+        if len(users) > limit:
+            users = users[:limit]
+            next_cursor = users[-1].id
+        items = [user.to_dict(fields=fields) for user in users]
+
+        data = {
+            'items': items,
+            '_meta': {
+                'limit': limit,
+                'next_cursor': next_cursor
+            }
+        }
+        return data
+
+    @staticmethod
+    def iter_collection_rows(cursor=None, limit=None, fields=None):
+        """ Построчный итератор по коллекции пользователей без создания моделей. """
+        query = User.select_fields(fields or User.PUBLIC_FIELDS).order_by(User.id)
+        if cursor is not None:
+            query = query.where(User.id > cursor)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.dicts().iterator()
+
+    @staticmethod
+    def search(q, limit, offset=0, fields=None):
+        """ Пользователи, у которых username начинается с q или email равен q.
+
+        По началу email не ищется: иначе чужой email, который API показывает
+        только владельцу, можно было бы подобрать по символу. Точное
+        совпадение email идет первым, затем короткие username. Префикс
+        username ищется по FTS5, без него - диапазонным запросом по
+        уникальному индексу (с учетом регистра).
+        """
+        query = User.select_fields(fields or User.PUBLIC_FIELDS, User.id)
+        order = (User.email != q, pw.fn.LENGTH(User.username), User.id)
+        match = 'username : "' + q.replace('"', '""') + '"*'
+        search = pw.Table('user_search', alias='user_search')
+        by_username = search.select(search.c.rowid).where(pw.SQL('user_search MATCH ?', [match]))
+        try:
+            users = list(query
+                         .where(User.id.in_(by_username) | (User.email == q))
+                         .order_by(*order)
+                         .limit(limit + 1)
+                         .offset(offset))
+        except pw.OperationalError as e:
+            if 'user_search' not in str(e):
+                raise
+            end = q + '\U0010ffff'
+            users = list(query
+                         .where((User.username >= q) & (User.username < end) | (User.email == q))
+                         .order_by(*order)
+                         .limit(limit + 1)
+                         .offset(offset))
+
+        data = {
+            'items': [user.to_dict(fields=fields) for user in users[:limit]],
+            '_meta': {
+                'q': q,
+                'limit': limit,
+                'offset': offset,
+                'next_offset': offset + limit if len(users) > limit else None
+            }
+        }
+        return data
 
     @staticmethod
-    def to_collection_dict():
+    def get_changes(since, limit):
+        """ Возвращает пользователей, измененных после курсора since (по change_seq).
+
+        Удаления в ленту не попадают.
+        """
+        query = (User
+                 .select(User.id, User.birthday, User.username, User.confirmed,
+                         User.created_at, User.updated_at, User.change_seq)
+                 .where(User.change_seq > since)
+                 .order_by(User.change_seq)
+                 .limit(limit + 1))
+        users = list(query)
+        has_more = len(users) > limit
+        users = users[:limit]
+        items = [dict(user.to_dict(), created_at=user.created_at, updated_at=user.updated_at)
+                 for user in users]
+
         data = {
-            'items': [item.to_dict() for item in User.select()]
+            'items': items,
+            '_meta': {
+                'since': since,
+                'limit': limit,
+                'next_cursor': users[-1].change_seq if users else since,
+                'has_more': has_more
+            }
         }
         return data
 
     def __repr__(self):
         return f'<User {self.username}>'
+
+
+class Session(pw.Model):
+    """ Сессия пользователя. Хранится только sha256 токена. """
+
+    class Meta:
+        database = db
+        table_name = 'session'
+
+    token_hash = pw.CharField(64, unique=True)
+    user = pw.ForeignKeyField(User, backref='sessions')
+    expires_at = pw.IntegerField(index=True)  # unix time
+    created_at = pw.IntegerField(default=now)  # unix time
+
+    @staticmethod
+    def hash_token(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
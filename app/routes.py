@@ -1,7 +1,8 @@
-from app import app
-from flask import render_template
+from flask import Blueprint, render_template
 
+bp = Blueprint('main', __name__)
 
-@app.route('/hello')
+
+@bp.route('/hello')
 def test():
     return render_template('hello.html', name='User')
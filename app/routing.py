@@ -0,0 +1,127 @@
+import sqlite3
+from queue import Empty, LifoQueue
+from threading import local
+from peewee import SqliteDatabase, SENTINEL, __exception_wrapper__
+from playhouse.pool import PooledSqliteDatabase
+from app.metrics import InstrumentedDatabaseMixin
+
+# настройки писателя, которые нельзя (или не нужно) задавать соединению только для чтения
+WRITER_PRAGMAS = ('journal_mode', 'synchronous')
+
+
+class ReadRoutingMixin(object):
+    """ Направляет SELECT в пул соединений только для чтения (mode=ro), остальное - писателю.
+
+    Читатели открывают тот же файл базы: в режиме WAL они не ждут писателя
+    и видят все завершенные транзакции. Внутри транзакции и после первой
+    записи до конца запроса (до close) чтения идут через писателя, поэтому
+    запрос всегда видит свои изменения.
+    """
+
+    def __init__(self, database, read_connections=0, **kwargs):
+        self.read_connections = read_connections
+        self._readers = LifoQueue()
+        self._route = local()
+        super().__init__(database, **kwargs)
+
+    def execute_sql(self, sql, params=None, commit=SENTINEL):
+        if sql[:6].upper() != 'SELECT':
+            self._route.wrote = True
+        elif self.read_connections and not self.in_transaction() and not getattr(self._route, 'wrote', False):
+            reader = self._get_reader()
+            if reader is not None:
+                with __exception_wrapper__:
+                    cursor = reader.cursor()
+                    cursor.execute(sql, params or ())
+                return cursor
+        return super().execute_sql(sql, params, commit)
+
+    def close(self):
+        """ Закрывает соединение писателя и возвращает читателя потока в пул. """
+        self._release_reader()
+        self._route.wrote = False
+        return super().close()
+
+    def close_readers(self):
+        """ Закрывает свободные соединения читателей. """
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except Empty:
+                return
+
+    def _get_reader(self):
+        reader = getattr(self._route, 'reader', None)
+        if reader is None:
+            try:
+                reader = self._readers.get_nowait()
+            except Empty:
+                reader = self._connect_reader()
+            self._route.reader = reader
+        return reader
+
+    def _release_reader(self):
+        reader = getattr(self._route, 'reader', None)
+        self._route.reader = None
+        if reader is None:
+            return
+        if self._readers.qsize() < self.read_connections:
+            self._readers.put(reader)
+        else:
+            reader.close()
+
+    def _connect_reader(self):
+        """ Новое соединение только для чтения или None (например, файла базы еще нет). """
+        try:
+            conn = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True, timeout=self._timeout,
+                                   isolation_level=None, check_same_thread=False)
+        except sqlite3.OperationalError:
+            return None
+        for key, value in self._pragmas:
+            if key not in WRITER_PRAGMAS:
+                conn.execute(f'PRAGMA {key} = {value}')
+        return conn
+
+
+class AfterCommitMixin(object):
+    """ Действия, отложенные до фиксации текущей транзакции потока (after_commit). """
+
+    def __init__(self, *args, **kwargs):
+        self._after_commit = local()
+        super().__init__(*args, **kwargs)
+
+    def after_commit(self, func):
+        """ Вызывает func после фиксации текущей транзакции, вне транзакции - сразу.
+
+        При откате транзакции func не вызывается; откат точки сохранения вызов не отменяет.
+        """
+        if not self.in_transaction():
+            func()
+            return
+        if not hasattr(self._after_commit, 'funcs'):
+            self._after_commit.funcs = []
+        self._after_commit.funcs.append(func)
+
+    def commit(self):
+        result = super().commit()
+        for func in self._pop_after_commit():
+            func()
+        return result
+
+    def rollback(self):
+        self._pop_after_commit()
+        return super().rollback()
+
+    def _pop_after_commit(self):
+        funcs = getattr(self._after_commit, 'funcs', [])
+        self._after_commit.funcs = []
+        return funcs
+
+
+class RoutedSqliteDatabase(InstrumentedDatabaseMixin, AfterCommitMixin, ReadRoutingMixin, SqliteDatabase):
+    pass
+
+
+class RoutedPooledSqliteDatabase(InstrumentedDatabaseMixin, AfterCommitMixin, ReadRoutingMixin,
+                                 PooledSqliteDatabase):
+    pass
@@ -0,0 +1,144 @@
+""" Prefork-сервер: несколько процессов-воркеров на общем слушающем сокете.
+
+Приложение создается один раз в главном процессе (preload), воркеры
+получают его через fork и вызывают post_fork. Упавший воркер
+перезапускается, SIGTERM/SIGINT останавливают все воркеры.
+
+Состояние в памяти у каждого воркера свое: кэш ответов при нескольких
+воркерах должен быть общим (RESPONSE_CACHE_BACKEND 'memory' заменяется
+на 'sqlite'), отзыв токенов кэши токенов видят через общий файл ревизий,
+лог каждый воркер пишет в свой файл, /api/metrics показывает счетчики
+ответившего воркера.
+Запуск из корня проекта:
+
+    python -m app.server --host 0.0.0.0 --port 5000 --workers 4
+"""
+import argparse
+import os
+import signal
+import socket
+import sys
+from time import monotonic, sleep
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import create_app, post_fork
+from app.cache import make_response_cache
+
+# воркер, проработавший меньше, перезапускается с задержкой (защита от цикла падений)
+MIN_WORKER_UPTIME = 1
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ Запросы пишет в лог приложение, построчный лог werkzeug в stderr не нужен. """
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def stop_worker(signum, frame):
+    sys.exit(0)
+
+
+def run_worker(app, sock, worker_id):
+    """ Тело процесса-воркера: многопоточный WSGI-сервер на унаследованном сокете. """
+    signal.signal(signal.SIGTERM, stop_worker)
+    signal.signal(signal.SIGINT, stop_worker)
+    post_fork(app, worker_id)
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, request_handler=QuietRequestHandler,
+                         fd=sock.fileno())
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        app.extensions['log_listener'].stop()
+
+
+class Arbiter(object):
+    """ Главный процесс: запускает воркеры и следит за ними. """
+
+    def __init__(self, app, sock, workers):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.pids = {}  # pid -> (worker_id, время запуска)
+        self.stopping = False
+
+    def spawn(self, worker_id):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.app, self.sock, worker_id)
+            except SystemExit:
+                pass
+            except BaseException:
+                self.app.logger.exception('Worker failed.')
+                code = 1
+            finally:
+                os._exit(code)
+        self.pids[pid] = (worker_id, monotonic())
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker_id in range(self.workers):
+            self.spawn(worker_id)
+        self.app.logger.info({'event': 'server_started', 'pid': os.getpid(), 'workers': self.workers,
+                              'address': '%s:%s' % self.sock.getsockname()[:2]})
+
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id, started = self.pids.pop(pid, (None, None))
+            if worker_id is None or self.stopping:
+                continue
+            self.app.logger.warning({'event': 'worker_exited', 'pid': pid, 'worker_id': worker_id,
+                                     'status': status})
+            if monotonic() - started < MIN_WORKER_UPTIME:
+                sleep(MIN_WORKER_UPTIME)
+            self.spawn(worker_id)
+
+
+def configure_workers(app, workers):
+    """ Согласует настройки приложения с числом воркеров (до fork). """
+    # размер пула хэширования по умолчанию делится между воркерами (читается в post_fork)
+    app.config['SERVER_WORKERS'] = workers
+    if workers > 1 and app.config['RESPONSE_CACHE_BACKEND'] == 'memory':
+        # запись, сделанная через один воркер, не сбросила бы кэш в памяти остальных
+        app.config['RESPONSE_CACHE_BACKEND'] = 'sqlite'
+        app.extensions['response_cache'] = make_response_cache(app.config)
+        app.logger.info({'event': 'response_cache_backend', 'backend': 'sqlite', 'workers': workers,
+                         'path': app.config['RESPONSE_CACHE_PATH']})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='число процессов')
+    parser.add_argument('--backlog', type=int, default=128)
+    args = parser.parse_args()
+
+    app = create_app()
+    configure_workers(app, args.workers)
+    sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+    try:
+        Arbiter(app, sock, args.workers).run()
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
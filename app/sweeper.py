@@ -0,0 +1,36 @@
+from app import db
+from app.models import User
+from threading import Event, Thread
+
+
+class TokenSweeper(Thread):
+    """ Фоновый поток, периодически очищающий истекшие токены. """
+
+    def __init__(self, app, interval, batch_size):
+        super().__init__(name='token-sweeper', daemon=True)
+        self.app = app
+        self.interval = interval
+        self.batch_size = batch_size
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.app.app_context(), db.connection_context():
+                    cleared = User.clear_expired_tokens(self.batch_size)
+                if cleared:
+                    self.app.logger.info({'event': 'tokens_swept', 'cleared': cleared})
+            except Exception:
+                self.app.logger.exception('Token sweep failed.')
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_token_sweeper(app):
+    """ Запускает TokenSweeper, если задан TOKEN_SWEEP_INTERVAL (секунды). """
+    if not app.config['TOKEN_SWEEP_INTERVAL']:
+        return None
+    sweeper = TokenSweeper(app, app.config['TOKEN_SWEEP_INTERVAL'], app.config['TOKEN_SWEEP_BATCH_SIZE'])
+    sweeper.start()
+    return sweeper
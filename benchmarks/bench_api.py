@@ -0,0 +1,228 @@
+""" Нагрузочный тест эндпоинтов API.
+
+Заполняет временную базу SQLite заданным числом пользователей и прогоняет
+эндпоинты через тестовый клиент Flask и через многопоточный WSGI-сервер,
+выводя запросы/сек и задержки p50/p95/p99. Результаты сохраняются в JSON,
+с --compare прогон сравнивается с предыдущим. База, лог и кэш ответов - во
+временном каталоге; кэш ответов по умолчанию выключен, чтобы повторные
+чтения измеряли работу с базой, а не попадания в кэш (--response-cache).
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_api --users 10000 --requests 500 --threads 8 \\
+        --output bench.json --compare baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+from base64 import b64encode
+from datetime import datetime
+from queue import Queue
+from time import perf_counter
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from app import create_app, db
+from app.migrations import migrate
+from app.models import User
+from app.api.tokens import generate_confirmation_token
+from app.server import QuietRequestHandler
+from config import Config
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+
+
+def seed(app, users, confirmations):
+    """ Создает пользователей и confirmations неподтвержденных.
+
+    Возвращает (токен, id, очередь ссылок подтверждения): каждая ссылка
+    подтверждает своего пользователя, поэтому используется один раз.
+    """
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    links = Queue()
+    with app.app_context(), db.connection_context():
+        migrate(db)
+        with db.atomic():
+            for i in range(0, users, 500):
+                User.insert_many([{
+                    'username': f'user{j}',
+                    'email': f'user{j}@bench.com',
+                    'password_hash': password_hash,
+                    'confirmed': True
+                } for j in range(i, min(i + 500, users))]).execute()
+            for i in range(0, confirmations, 500):
+                User.insert_many([{
+                    'username': f'confirm{j}',
+                    'email': f'confirm{j}@bench.com',
+                    'password_hash': password_hash
+                } for j in range(i, min(i + 500, confirmations))]).execute()
+        user = User.create(username=BENCH_USER, email='bench@bench.com',
+                           password_hash=password_hash, confirmed=True)
+        for unconfirmed in User.select(User.id).where(User.confirmed == False):
+            links.put(generate_confirmation_token(unconfirmed))
+        return user.get_token(), user.id, links
+
+
+def endpoints(token, user_id, links):
+    """ Эндпоинты: имя -> (метод, путь или функция, возвращающая путь, Authorization). """
+    basic = 'Basic ' + b64encode(f'{BENCH_USER}:{BENCH_PASSWORD}'.encode()).decode()
+    bearer = f'Bearer {token}'
+    return {
+        'POST /api/tokens': ('POST', '/api/tokens', basic),
+        'GET /api/users': ('GET', '/api/users', bearer),
+        'GET /api/users/<id>': ('GET', f'/api/users/{user_id}', bearer),
+        'GET /api/users/search': ('GET', '/api/users/search?q=user12', bearer),
+        'GET /api/confirm/<token>': ('GET', lambda: f'/api/confirm/{links.get_nowait()}', None),
+    }
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def run_client(app, method, path, auth, requests):
+    """ Последовательные запросы через тестовый клиент Flask. """
+    client = app.test_client()
+    headers = {'Authorization': auth} if auth else {}
+    latencies, errors = [], 0
+    start = perf_counter()
+    for _ in range(requests):
+        url = path() if callable(path) else path
+        t = perf_counter()
+        resp = client.open(url, method=method, headers=headers)
+        latencies.append(perf_counter() - t)
+        errors += resp.status_code >= 400
+    return summarize(latencies, errors, perf_counter() - start)
+
+
+def run_server(base_url, method, path, auth, requests, threads):
+    """ Параллельные HTTP-запросы к многопоточному WSGI-серверу. """
+    headers = {'Authorization': auth} if auth else {}
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+
+    def worker(count):
+        local = []
+        local_errors = 0
+        for _ in range(count):
+            url = base_url + (path() if callable(path) else path)
+            t = perf_counter()
+            try:
+                urlopen(Request(url, method=method, headers=headers)).read()
+            except HTTPError as e:  # любой ответ 4xx/5xx
+                e.read()
+                local_errors += 1
+            local.append(perf_counter() - t)
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    workers = [threading.Thread(target=worker, args=(requests // threads,)) for _ in range(threads)]
+    start = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summarize(latencies, errors[0], perf_counter() - start)
+
+
+def compare(results, baseline, threshold):
+    """ Возвращает список регрессий rps/p95 относительно прошлого прогона. """
+    regressions = []
+    for mode, mode_results in results.items():
+        for name, current in mode_results.items():
+            previous = baseline.get('results', {}).get(mode, {}).get(name)
+            if not previous:
+                continue
+            if current['rps'] < previous['rps'] * (1 - threshold):
+                regressions.append(f'{mode} {name}: rps {previous["rps"]} -> {current["rps"]}')
+            if current['p95_ms'] > previous['p95_ms'] * (1 + threshold):
+                regressions.append(f'{mode} {name}: p95 {previous["p95_ms"]} -> {current["p95_ms"]} ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='размер базы')
+    parser.add_argument('--requests', type=int, default=500, help='запросов на эндпоинт')
+    parser.add_argument('--threads', type=int, default=8, help='клиентских потоков для сервера')
+    parser.add_argument('--modes', default='client,server')
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--threshold', type=float, default=0.1, help='допустимое ухудшение, доля')
+    parser.add_argument('--response-cache', choices=['none', 'memory', 'sqlite'], default='none',
+                        help='RESPONSE_CACHE_BACKEND')
+    args = parser.parse_args()
+
+    modes = args.modes.split(',')
+    results = {mode: {} for mode in modes}
+    with tempfile.TemporaryDirectory() as tmp:
+        app = create_app(type('BenchConfig', (Config,), {
+            'DATABASE_PATH': os.path.join(tmp, 'bench.db'),
+            'LOG_FILE': os.path.join(tmp, 'bench.log'),
+            'RESPONSE_CACHE_BACKEND': None if args.response_cache == 'none' else args.response_cache,
+            'RESPONSE_CACHE_PATH': os.path.join(tmp, 'cache.db'),
+        }))
+        targets = endpoints(*seed(app, args.users, args.requests * len(modes)))
+
+        if 'client' in modes:
+            for name, (method, path, auth) in targets.items():
+                results['client'][name] = run_client(app, method, path, auth, args.requests)
+
+        if 'server' in modes:
+            server = make_server('127.0.0.1', 0, app, threaded=True,
+                                 request_handler=QuietRequestHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+            try:
+                for name, (method, path, auth) in targets.items():
+                    results['server'][name] = run_server(base_url, method, path, auth,
+                                                         args.requests, args.threads)
+            finally:
+                server.shutdown()
+
+    for mode, mode_results in results.items():
+        for name, r in mode_results.items():
+            print(f'{mode:6} {name:26} {r["rps"]:>9} rps  p50 {r["p50_ms"]:>8} ms  '
+                  f'p95 {r["p95_ms"]:>8} ms  p99 {r["p99_ms"]:>8} ms  errors {r["errors"]}')
+
+    report = {
+        'meta': dict(vars(args), date=datetime.utcnow().isoformat()),
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get('meta', {}).get('response_cache', 'memory') != args.response_cache:
+            print('WARNING: baseline was measured with another --response-cache')
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
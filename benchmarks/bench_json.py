@@ -0,0 +1,52 @@
+""" Сравнение кодирования ответов: jsonify против app.encoding и кэша тел ошибок.
+
+    python -m benchmarks.bench_json --number 20000
+"""
+import argparse
+from datetime import date
+from timeit import timeit
+
+from flask import jsonify, make_response
+
+from app import create_app
+from app.api.errors import InvalidTokenError
+from app.encoding import json_response, orjson
+
+
+def jsonify_error(error):
+    """ Прежний ApiError.make_response. """
+    return make_response(jsonify({
+        'message': error.message,
+        'code': error.api_code
+    }), error.http_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--items', type=int, default=100, help='пользователей в коллекции')
+    args = parser.parse_args()
+
+    collection = {'items': [{
+        'id': i,
+        'birthday': date(2000, 9, 20),
+        'username': f'user{i}',
+        'confirmed': True
+    } for i in range(args.items)]}
+
+    cases = [
+        ('error: jsonify', lambda: jsonify_error(InvalidTokenError())),
+        ('error: cached body', lambda: InvalidTokenError().make_response()),
+        (f'collection[{args.items}]: jsonify', lambda: jsonify(collection)),
+        (f'collection[{args.items}]: json_response', lambda: json_response(collection)),
+    ]
+    print(f'encoder: {"orjson" if orjson is not None else "json (stdlib)"}')
+    app = create_app()
+    with app.app_context():
+        for name, func in cases:
+            seconds = timeit(func, number=args.number)
+            print(f'{name:36} {seconds / args.number * 1e6:>9.2f} us/op')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+""" Пропускная способность SQLite при параллельных чтении и записи.
+
+Сравнивает настройки базы по умолчанию и DATABASE_PRAGMAS из Config.
+Запуск из корня проекта:
+
+    python -m benchmarks.bench_sqlite --users 10000 --readers 8 --writers 2 --seconds 5
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+from time import perf_counter
+
+from peewee import SqliteDatabase, OperationalError
+from werkzeug.security import generate_password_hash
+
+from app.migrations import MODELS
+from app.models import User
+from config import Config
+
+
+def seed(path, users):
+    database = SqliteDatabase(path)
+    password_hash = generate_password_hash('bench')
+    with database.bind_ctx(MODELS):
+        database.create_tables(MODELS)
+        with database.atomic():
+            for i in range(0, users, 500):
+                User.insert_many([{
+                    'username': f'user{j}',
+                    'email': f'user{j}@bench.com',
+                    'password_hash': password_hash,
+                    'confirmed': True
+                } for j in range(i, min(i + 500, users))]).execute()
+    database.close()
+
+
+def run(path, pragmas, users, readers, writers, seconds):
+    """ Возвращает число операций и ошибок блокировки для каждой роли. """
+    database = SqliteDatabase(path, pragmas=pragmas)
+    stop = threading.Event()
+    stats = {'read': [0, 0], 'write': [0, 0]}
+    stats_lock = threading.Lock()
+
+    def worker(role):
+        ops = errors = 0
+        database.connect(reuse_if_open=True)
+        while not stop.is_set():
+            id = random.randint(1, users)
+            try:
+                if role == 'read':
+                    User.get_or_none(User.id == id)
+                else:
+                    with database.atomic():
+                        User.update(birthday='2000-01-01').where(User.id == id).execute()
+                ops += 1
+            except OperationalError:  # database is locked
+                errors += 1
+        database.close()
+        with stats_lock:
+            stats[role][0] += ops
+            stats[role][1] += errors
+
+    with database.bind_ctx(MODELS):
+        threads = [threading.Thread(target=worker, args=('read',)) for _ in range(readers)]
+        threads += [threading.Thread(target=worker, args=('write',)) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        start = perf_counter()
+        stop.wait(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+
+    return {role: {'ops_per_sec': round(ops / elapsed, 1), 'locked_errors': errors}
+            for role, (ops, errors) in stats.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    configs = [
+        ('default', {}),
+        ('tuned', Config.DATABASE_PRAGMAS),
+    ]
+    for name, pragmas in configs:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench.db')
+            seed(path, args.users)
+            result = run(path, pragmas, args.users, args.readers, args.writers, args.seconds)
+        print(f'{name:8} read {result["read"]["ops_per_sec"]:>10} ops/s '
+              f'(locked {result["read"]["locked_errors"]}), '
+              f'write {result["write"]["ops_per_sec"]:>10} ops/s '
+              f'(locked {result["write"]["locked_errors"]})')
+
+
+if __name__ == '__main__':
+    main()
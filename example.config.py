@@ -1,6 +1,8 @@
 import os
+from app.default_config import DefaultConfig
 
 
-class Config(object):
+# остальные настройки и их значения по умолчанию - в app/default_config.py
+class Config(DefaultConfig):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'secret_key'
     SECURITY_PASSWORD_SALT = 'password_salt'
@@ -1,22 +1,54 @@
+import atexit
+import json
+import os
+import sqlite3
+import tempfile
 import unittest
+from threading import BoundedSemaphore
 from base64 import b64encode
-from peewee import SqliteDatabase
-from app import app
-from app.models import User
+from datetime import date, datetime
+from flask import jsonify
+from werkzeug.security import generate_password_hash
+from app import create_app, post_fork, db, token_cache as current_token_cache
+from app.cache import CachedResponse, MemoryResponseCache, SqliteResponseCache, TokenRevisions
+from app import hashing
+from app.encoding import dumps
+import app.api.errors as apiErr
+from app.models import User, TableVersion, Session
 from app.api.tokens import generate_confirmation_token
+from app.migrations import MigrationError, migrate
+from app.routing import RoutedSqliteDatabase
+from config import Config
 
-MODELS = [User]
-test_db = SqliteDatabase(':memory:')
+MODELS = [User, TableVersion, Session]
+test_db = RoutedSqliteDatabase(':memory:', read_connections=0)
+# файлы базы (в том числе после post_fork) и лога - во временном каталоге, не в рабочем дереве
+test_dir = tempfile.TemporaryDirectory()
+
+
+class TestConfig(Config):
+    TESTING = True
+    LOGIN_DISABLED = False
+    RESPONSE_CACHE_BACKEND = 'memory'
+    DATABASE_PATH = os.path.join(test_dir.name, 'data.db')
+    LOG_FILE = os.path.join(test_dir.name, 'app.log')
+    TOKEN_SWEEP_INTERVAL = 0
+
+
+app = create_app(TestConfig)
+response_cache = app.extensions['response_cache']
+token_cache = app.extensions['token_cache']
+metrics = app.extensions['metrics']
 
 
 class ApiServiceTestCase(unittest.TestCase):
 
     def setUp(self):
-        app.config['TESTING'] = True
-        app.config['LOGIN_DISABLED'] = False
         test_db.bind(MODELS, bind_refs=False, bind_backrefs=False)
         test_db.connect()
         test_db.create_tables(MODELS)
+        token_cache.clear()
+        response_cache.clear()
         self.app = app.test_client()
 
     def tearDown(self):
@@ -33,12 +65,18 @@ class ApiServiceTestCase(unittest.TestCase):
             }
 
         user = User()
-        user.from_dict(data, new_user=True)
+        with app.app_context():
+            user.from_dict(data, new_user=True)
         if confirm:
             user.confirmed = True
         user.save()
         return user
 
+    @staticmethod
+    def confirmation_url(user):
+        with app.app_context():
+            return f'/api/confirm/{generate_confirmation_token(user)}'
+
     def test_valid_add_user(self):
         """ Тест верного добавления пользователя. """
 
@@ -78,13 +116,13 @@ class ApiServiceTestCase(unittest.TestCase):
         """ Тест подтверждения email. """
 
         user = self.create_user(confirm=False)
-        valid_url = f'/api/confirm/{generate_confirmation_token(user)}'
+        valid_url = self.confirmation_url(user)
 
         test_u = User()
         test_u.email = 'invalid_email'
         invalid_urls = [
             valid_url + '0',
-            '/api/confirm/' + generate_confirmation_token(test_u)
+            self.confirmation_url(test_u)
         ]
 
         # Передача неверного токена
@@ -331,6 +369,873 @@ class ApiServiceTestCase(unittest.TestCase):
             self.assertIn(param, resp.json, f'{param} not included.')
         self.assertNotIn('password_hash', resp.json, 'password_hash include.')
 
+    def test_get_users_pagination(self):
+        """ Постраничная выдача списка пользователей. """
+
+        tokens = []
+        for i in range(0, 5):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            tokens.append(user.get_token())
+        headers = {'Authorization': f"Bearer {tokens[0]}"}
+
+        # invalid request
+        for query in ['limit=0', 'limit=abc', 'cursor=-1']:
+            resp = self.app.get(f'/api/users?{query}', headers=headers)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+
+        # valid request - обход всех страниц по ссылке next
+        usernames = []
+        url = '/api/users?limit=2'
+        while url:
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+            self.assertLessEqual(len(resp.json['items']), 2)
+            usernames += [item['username'] for item in resp.json['items']]
+            url = resp.json['_links']['next']
+
+        self.assertEqual(usernames, [f'user{i}' for i in range(0, 5)])
+
+    def test_get_users_stream(self):
+        """ Потоковая выдача списка пользователей. """
+
+        token = None
+        for i in range(0, 5):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com',
+                'birthday': '2000-09-20'
+            })
+            token = user.get_token()
+        headers = {'Authorization': f"Bearer {token}"}
+
+        resp = self.app.get('/api/users?stream=1', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertTrue(resp.is_streamed, 'Response not streamed.')
+        self.assertEqual(resp.json['items'], self.app.get('/api/users', headers=headers).json['items'])
+
+        resp = self.app.get('/api/users?stream=1&cursor=2&limit=2', headers=headers)
+        self.assertEqual([item['username'] for item in resp.json['items']], ['user2', 'user3'])
+
+    def test_token_cache(self):
+        """ Кэширование проверки токена и его инвалидация. """
+
+        user = self.create_user()
+        token = user.get_token()
+        headers = {'Authorization': f"Bearer {token}"}
+
+        self.app.get(f'/api/users/{user.id}', headers=headers)
+        hits = token_cache.stats()['hits_total']
+        resp = self.app.get(f'/api/users/{user.id}', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual(token_cache.stats()['hits_total'], hits + 1, 'Token not cached.')
+
+        # изменение пользователя сбрасывает кэш
+        self.app.put(f'/api/users/{user.id}', headers=headers, json={'username': 'test_cache'})
+        self.assertEqual(token_cache.stats()['size'], 0, 'Cache not invalidated.')
+        resp = self.app.get(f'/api/users/{user.id}', headers=headers)
+        self.assertEqual(resp.json['username'], 'test_cache', resp.json['username'])
+
+        # отзыв токена сбрасывает кэш
+        self.app.delete('/api/tokens', headers=headers)
+        resp = self.app.get(f'/api/users/{user.id}', headers=headers)
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1002, f'code == {resp.json["code"]}')
+
+    def test_token_migration(self):
+        """ Перенос токенов из столбцов user (в том числе со строковым сроком) в таблицу session. """
+
+        user = self.create_user()
+        test_db.drop_tables([Session])
+        test_db.execute_sql('ALTER TABLE "user" ADD COLUMN token VARCHAR(32)')
+        test_db.execute_sql('ALTER TABLE "user" ADD COLUMN token_expiration INTEGER')
+        test_db.execute_sql(
+            'UPDATE "user" SET token = ?, token_expiration = ? WHERE id = ?',
+            ('old_token', '2100-01-01 00:00:00', user.id))
+
+        migrate(test_db)
+
+        self.assertNotIn('token', [column.name for column in test_db.get_columns('user')])
+        self.assertEqual(Session.get(Session.user == user.id).expires_at, 4102444800)
+        self.assertEqual(User.check_token('old_token'), user)
+
+    def test_search_after_migration(self):
+        """ После миграции схемы user-022 (токены в user) новые пользователи находятся поиском. """
+
+        user = self.create_user()
+        test_db.drop_tables([Session])
+        test_db.execute_sql('ALTER TABLE "user" ADD COLUMN token VARCHAR(32)')
+        test_db.execute_sql('ALTER TABLE "user" ADD COLUMN token_expiration INTEGER')
+
+        migrate(test_db)
+
+        triggers = [row[0] for row in test_db.execute_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'user_search%'")]
+        self.assertEqual(len(triggers), 3, triggers)
+        resp = self.app.post('/api/users', json={'username': 'newcomer', 'password': 'test',
+                                                 'email': 'newcomer@gg.com'})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        resp = self.app.get('/api/users/search?q=newc', headers=headers)
+        self.assertEqual([item['username'] for item in resp.json['items']], ['newcomer'])
+
+    def test_add_user_used_data(self):
+        """ Регистрация с уже занятыми username/email. """
+
+        self.create_user()
+
+        for json, code in [({'username': 'test', 'password': 'test', 'email': 'other@gg.com'}, 1008),
+                           ({'username': 'other', 'password': 'test', 'email': 'test@gg.com'}, 1009)]:
+            resp = self.app.post('/api/users', json=json)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], code, f'code == {resp.json["code"]}')
+        self.assertEqual(User.select().count(), 1, 'User added.')
+
+    def test_user_constraint_errors(self):
+        """ Нарушение NOT NULL - ошибка параметров, а не занятое имя. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        for json in [{'username': None}, {'email': None}]:
+            resp = self.app.put(f'/api/users/{user.id}', headers=headers, json=json)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+        self.assertEqual(User.get_by_id(user.id).username, 'test')
+
+    def test_migration_duplicates(self):
+        """ Повторы username мешают создать уникальный индекс: миграция сообщает о них. """
+
+        self.create_user()
+        test_db.execute_sql('DROP INDEX user_username')
+        User.insert(username='test', email='copy@gg.com', password_hash='x').execute()
+
+        with self.assertRaises(MigrationError) as context:
+            migrate(test_db)
+        self.assertIn("user.username", str(context.exception))
+        self.assertIn("'test' (2)", str(context.exception))
+
+    def test_add_users_batch(self):
+        """ Пакетная регистрация пользователей (только администратором). """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        resp = self.app.post('/api/users/batch', json={'items': []})
+        self.assertEqual(resp.json['code'], apiErr.InvalidTokenError().api_code, f'code == {resp.json["code"]}')
+        resp = self.app.post('/api/users/batch', headers=headers, json={'items': []})
+        self.assertEqual(resp.json['code'], apiErr.RightsError().api_code, f'code == {resp.json["code"]}')
+        User.update(admin=True).where(User.id == user.id).execute()
+
+        resp = self.app.post('/api/users/batch', headers=headers, json={'items': []})
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1007, f'code == {resp.json["code"]}')
+
+        items = [{
+            'username': f'batch{i}',
+            'password': f'batch{i}',
+            'email': f'batch{i}@gg.com'
+        } for i in range(0, 3)]
+        items += [
+            {'username': 'batch_no_email', 'password': 'batch'},
+            {'username': 'test', 'password': 'batch', 'email': 'batch_new@gg.com'},
+            {'username': 'batch_new', 'password': 'batch', 'email': 'batch0@gg.com'}
+        ]
+
+        resp = self.app.post('/api/users/batch', headers=headers, json={'items': items})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        result = resp.json['items']
+        self.assertEqual([item['index'] for item in result], list(range(0, 6)))
+        for i in range(0, 3):
+            user = User.get_or_none(User.username == f'batch{i}')
+            self.assertTrue(user, 'User not added.')
+            self.assertEqual(result[i]['id'], user.id)
+            with app.app_context():
+                self.assertTrue(user.check_password(f'batch{i}'), 'Wrong password hash.')
+        self.assertEqual([item.get('code') for item in result[3:]], [1007, 1008, 1009])
+        self.assertEqual(User.select().count(), 4)
+
+        resp = self.app.post('/api/users/batch', headers=headers, json=[{'items': items}])
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1007, f'code == {resp.json["code"]}')
+
+        resp = self.app.post('/api/users/batch', headers=headers, json={'items': [
+            {'username': 'batch_date', 'password': 'batch', 'email': 'batch_date@gg.com', 'birthday': {}},
+            {'username': 'batch_ok', 'password': 'batch', 'email': 'batch_ok@gg.com', 'birthday': '2000-09-20'}
+        ]})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual([item.get('code') for item in resp.json['items']], [1010, None])
+        self.assertTrue(User.get_or_none(User.username == 'batch_ok'), 'User not added.')
+
+    def test_get_users_by_ids(self):
+        """ Запрос нескольких пользователей по списку id. """
+
+        ids = []
+        tokens = []
+        for i in range(0, 2):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            tokens.append(user.get_token())
+            ids.append(user.id)
+        headers = {'Authorization': f"Bearer {tokens[0]}"}
+
+        resp = self.app.get('/api/users?ids=1,a', headers=headers)
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+
+        missing_id = ids[0] + ids[1]
+        resp = self.app.get(f'/api/users?ids={ids[0]},{ids[1]},{missing_id},{ids[0]}', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual([item['id'] for item in resp.json['items']], [ids[0]])
+        self.assertIn('email', resp.json['items'][0], 'email not included.')
+        self.assertEqual(resp.json['missing'], [missing_id])
+        self.assertEqual(resp.json['errors'], [{'id': ids[1], 'code': 1005, 'message': 'Insufficient rights.'}])
+
+    def test_logging_request(self):
+        """ Одна запись лога на запрос с обрезанными телами, без паролей. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        app.config['LOG_PAYLOAD_LIMIT'] = 16
+        try:
+            with self.assertLogs(app.logger, 'INFO') as logs:
+                self.app.get('/api/users/search?q=j', headers=headers, json={'comment': 'x' * 32})
+                self.app.post('/api/users', json={'username': 'test_log', 'password': 'secret_password'})
+                self.app.put(f'/api/users/{user.id}', headers=headers,
+                             json={'username': 'test_log', 'password': 'secret_password'})
+        finally:
+            app.config['LOG_PAYLOAD_LIMIT'] = 1024
+
+        self.assertEqual(len(logs.records), 3, 'Not one record per request.')
+        record = logs.records[0].msg
+        self.assertEqual(record['status'], 400, f'status == {record["status"]}')
+        self.assertEqual(record['path'], '/api/users/search?q=j')
+        self.assertEqual(len(record['request']), 16, 'Payload not truncated.')
+        for record in logs.records[1:]:
+            self.assertEqual(record.msg['request'], {'username': 'test_log'})
+            self.assertNotIn('secret_password', str(record.msg))
+
+    def test_metrics(self):
+        """ Метрики в формате Prometheus. """
+
+        resp = self.app.get('/api/metrics')
+        self.assertEqual(resp.status_code, 404, f'status_code == {resp.status_code}')
+
+        metrics.enabled = True
+        try:
+            user = self.create_user()
+            self.app.get('/api/users')
+            self.app.get(f'/api/users/{user.id}', headers={'Authorization': f"Bearer {user.get_token()}"})
+            resp = self.app.get('/api/metrics')
+        finally:
+            metrics.enabled = False
+            metrics.clear()
+
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        text = resp.get_data(as_text=True)
+        for line in ['api_errors_total{code="1002"} 1',
+                     'api_request_duration_seconds_count{endpoint="api.get_user",method="GET",status="200"} 1',
+                     'api_password_hash_seconds_count{op="set"} 1',
+                     '# TYPE api_token_cache_misses_total counter',
+                     'api_token_cache_misses_total ',
+                     '# TYPE api_token_cache_size gauge',
+                     '# TYPE api_password_hash_rejected_total counter',
+                     '# TYPE api_password_hash_in_flight gauge']:
+            self.assertIn(line, text, f'{line} not included.')
+
+    def test_etag(self):
+        """ Условный GET по ETag. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+
+        for url in [f'/api/users/{user.id}', '/api/users']:
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+            etag = resp.headers['ETag']
+
+            resp = self.app.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(resp.status_code, 304, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.data, b'', 'Body not empty.')
+
+            # смена токена не меняет данные пользователя
+            user = User.get_by_id(user.id)
+            user.revoke_token()
+            headers = {'Authorization': f"Bearer {user.get_token()}"}
+            resp = self.app.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(resp.status_code, 304, f'status_code == {resp.status_code}')
+
+            # изменение пользователя меняет ETag
+            self.app.put(f'/api/users/{user.id}', headers=headers, json={'username': f'test_etag{url}'})
+            resp = self.app.get(url, headers=dict(headers, **{'If-None-Match': etag}))
+            self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_response_cache(self):
+        """ Кэш ответов и его инвалидация при записи. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+
+        for url in [f'/api/users/{user.id}', '/api/users']:
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+
+            # запись в обход API не сбрасывает кэш
+            User.update(username=f'cached{url}').where(User.id == user.id).execute()
+            resp = self.app.get(url, headers=headers)
+            self.assertNotIn(f'cached{url}', resp.get_data(as_text=True), 'Response not cached.')
+
+            # изменение через API сбрасывает кэш
+            self.app.put(f'/api/users/{user.id}', headers=headers, json={'username': f'put{url}'})
+            resp = self.app.get(url, headers=headers)
+            self.assertIn(f'put{url}', resp.get_data(as_text=True), 'Cache not invalidated.')
+
+        # регистрация сбрасывает кэш коллекции
+        self.app.post('/api/users', json={'username': 'new', 'password': 'new', 'email': 'new@gg.com'})
+        resp = self.app.get('/api/users', headers=headers)
+        self.assertEqual(len(resp.json['items']), 2)
+
+    def test_sqlite_response_cache(self):
+        """ Общий для процессов кэш ответов в файле SQLite. """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = SqliteResponseCache(os.path.join(tmp, 'cache.db'), maxsize=2)
+            other = SqliteResponseCache(os.path.join(tmp, 'cache.db'), maxsize=2)
+            value = CachedResponse(b'{}', 200, 'application/json', 'etag')
+
+            cache.set('a', value, ['users', 'user:1'], cache.generation())
+            self.assertEqual(other.get('a'), value)
+
+            # ответ, собранный до инвалидации, не сохраняется
+            generation = cache.generation()
+            other.invalidate('user:1')
+            self.assertIsNone(cache.get('a'))
+            cache.set('a', value, ['users'], generation)
+            self.assertIsNone(cache.get('a'))
+
+            for key in ['a', 'b', 'c']:
+                cache.set(key, value, ['users'], cache.generation())
+            self.assertIsNone(cache.get('a'), 'LRU not evicted.')
+
+            # недавно использованный ответ отдается без записи в файл
+            changes = other._connection().total_changes
+            self.assertEqual(other.get('c'), value)
+            self.assertEqual(other._connection().total_changes, changes, 'Cache hit wrote to the file.')
+
+            other.invalidate('users')
+            self.assertIsNone(cache.get('c'))
+
+            # очистка (invalidate_all) тоже не дает сохранить ответ, собранный до нее
+            for backend in [cache, MemoryResponseCache()]:
+                generation = backend.generation()
+                backend.clear()
+                backend.set('a', value, ['users'], generation)
+                self.assertIsNone(backend.get('a'))
+            cache.close()
+            other.close()
+
+    def test_encoding(self):
+        """ Кодирование JSON совпадает с jsonify, тела ошибок кэшируются. """
+
+        data = {'birthday': date(2000, 9, 20), 'time': datetime(2019, 6, 1, 12, 30, 5), 'id': 1}
+        with app.app_context():
+            self.assertEqual(json.loads(dumps(data)), jsonify(data).get_json())
+
+            self.assertIs(apiErr.InvalidTokenError().get_body(), apiErr.InvalidTokenError().get_body())
+            body = apiErr.InvalidTokenError('Other message.').make_response().get_json()
+        self.assertEqual(body, {'message': 'Other message.', 'code': 1002})
+
+    def test_password_hashing(self):
+        """ Перехэширование старого пароля при входе и ограничение очереди хэширования. """
+
+        user = self.create_user()
+        User.update(password_hash=generate_password_hash('test', method='pbkdf2:sha256:1000', salt_length=8)) \
+            .where(User.id == user.id).execute()
+        headers = {'Authorization': b"Basic " + b64encode("test:test".encode())}
+
+        resp = self.app.post('/api/tokens', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        user = User.get_by_id(user.id)
+        hasher = app.extensions['password_hasher']
+        with app.app_context():
+            self.assertFalse(user.password_needs_rehash(), user.password_hash)
+            self.assertTrue(user.check_password('test'))
+
+        # более стойкий хэш вход не ослабляет
+        iterations = int(app.config['PASSWORD_HASH_METHOD'].rsplit(':', 1)[1]) + 1
+        strong_hash = generate_password_hash('test', method=f'pbkdf2:sha512:{iterations}', salt_length=32)
+        User.update(password_hash=strong_hash).where(User.id == user.id).execute()
+        resp = self.app.post('/api/tokens', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual(User.get_by_id(user.id).password_hash, strong_hash)
+        with app.app_context():
+            for method in ['sha256', f'pbkdf2:sha1:{iterations}', 'pbkdf2:sha256:1000']:
+                self.assertTrue(hasher.needs_rehash(generate_password_hash('test', method=method, salt_length=16)))
+
+        slots = hasher._slots
+        hasher._slots = BoundedSemaphore(1)
+        hasher._slots.acquire()
+        try:
+            resp = self.app.post('/api/tokens', headers=headers)
+        finally:
+            hasher._slots = slots
+        self.assertEqual(resp.status_code, 503, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1011, f'code == {resp.json["code"]}')
+
+        # пачка хэшируется в своем пуле и не занимает очередь входа, вторая пачка - 503
+        hasher._slots.acquire()
+        try:
+            with app.app_context():
+                self.assertEqual(len(hashing.hash_passwords(['a', 'b'])), 2)
+        finally:
+            hasher._slots.release()
+        User.update(admin=True).where(User.id == user.id).execute()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        hasher._batch_slot.acquire()
+        try:
+            resp = self.app.post('/api/users/batch', headers=headers, json={'items': [
+                {'username': 'batch', 'password': 'batch', 'email': 'batch@gg.com'}]})
+        finally:
+            hasher._batch_slot.release()
+        self.assertEqual(resp.status_code, 503, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1011, f'code == {resp.json["code"]}')
+
+    def test_expired_confirmation_link(self):
+        """ Истекшая ссылка подтверждения. """
+
+        user = self.create_user(confirm=False)
+        url = self.confirmation_url(user)
+
+        app.config['CONFIRM_TOKEN_MAX_AGE'] = -1
+        try:
+            resp = self.app.get(url)
+        finally:
+            app.config['CONFIRM_TOKEN_MAX_AGE'] = 7 * 24 * 3600
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1001, f'code == {resp.json["code"]}')
+        self.assertFalse(User.get_by_id(user.id).confirmed, 'Email confirmed.')
+
+    def test_clear_expired_tokens(self):
+        """ Очистка истекших токенов пачками. """
+
+        tokens = []
+        for i in range(0, 4):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            tokens.append(user.get_token(expires_in=-1 if i < 3 else 3600))
+
+        self.assertEqual(User.clear_expired_tokens(batch_size=2), 3)
+        self.assertEqual(Session.select().count(), 1)
+        self.assertTrue(User.check_token(tokens[3]), 'Valid token cleared.')
+
+    def test_revoke_tokens(self):
+        """ Массовый отзыв токенов администратором. """
+
+        ids = []
+        tokens = []
+        for i in range(0, 3):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            tokens.append(user.get_token())
+            ids.append(user.id)
+        User.update(admin=True).where(User.id == ids[0]).execute()
+
+        resp = self.app.post('/api/tokens/revoke', headers={'Authorization': f"Bearer {tokens[1]}"},
+                             json={'all': True})
+        self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json['code'], 1005, f'code == {resp.json["code"]}')
+
+        headers = {'Authorization': f"Bearer {tokens[0]}"}
+        for json in [{}, {'ids': []}, {'all': 'yes'}]:
+            resp = self.app.post('/api/tokens/revoke', headers=headers, json=json)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1007, f'code == {resp.json["code"]}')
+
+        resp = self.app.post('/api/tokens/revoke', headers=headers, json={'ids': [ids[1]]})
+        self.assertEqual(resp.json['revoked'], 1)
+        self.assertIsNone(User.check_token(tokens[1]))
+        self.assertTrue(User.check_token(tokens[2]))
+
+        resp = self.app.post('/api/tokens/revoke', headers=headers, json={'all': True})
+        self.assertEqual(resp.json['revoked'], 2)
+        for token in tokens:
+            self.assertIsNone(User.check_token(token))
+
+    def test_revocation_in_other_process(self):
+        """ Отзыв в другом процессе (CLI, другой воркер) виден кэшу токенов без запросов к базе. """
+
+        user = self.create_user()
+        other = self.create_user({'username': 'other', 'password': 'test', 'email': 'other@gg.com'})
+        token, other_token = user.get_token(), other.get_token()
+        with app.app_context():
+            self.assertEqual(User.check_token(token), user)
+            self.assertEqual(User.check_token(other_token), other)
+            # попадание в кэш не обращается к базе
+            with self.assertNoLogs('peewee', 'DEBUG'):
+                self.assertEqual(User.check_token(token), user)
+
+        # другой процесс: свои ревизии на том же файле
+        revisions = TokenRevisions(token_cache.revisions.path)
+        try:
+            Session.delete().where(Session.user == other.id).execute()
+            revisions.bump([other.id])
+            with app.app_context():
+                self.assertIsNone(User.check_token(other_token))
+                # выход другого пользователя не вытесняет чужие токены
+                with self.assertNoLogs('peewee', 'DEBUG'):
+                    self.assertEqual(User.check_token(token), user)
+
+            Session.delete().execute()
+            revisions.bump()
+            with app.app_context():
+                self.assertIsNone(User.check_token(token))
+
+            # сессия, отозванная во время ее поиска, не кэшируется
+            epoch = token_cache.revisions.epoch()
+            revisions.bump([other.id])
+            token_cache.set(token, user, None, epoch)
+            self.assertEqual(token_cache.stats()['size'], 0)
+        finally:
+            revisions.close()
+
+        # права администратора проверяются по базе, а не по кэшу
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        test_db.execute_sql('UPDATE "user" SET admin = 1 WHERE id = ?', (user.id,))
+        resp = self.app.post('/api/tokens/revoke', headers=headers, json={'ids': [other.id]})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        test_db.execute_sql('UPDATE "user" SET admin = 0 WHERE id = ?', (user.id,))
+        resp = self.app.post('/api/tokens/revoke', headers=headers, json={'ids': [other.id]})
+        self.assertEqual(resp.json['code'], apiErr.RightsError().api_code)
+
+        # истечение сессии ревизий не меняет
+        epoch = token_cache.revisions.epoch()
+        user.get_token(expires_in=-1)
+        User.clear_expired_tokens()
+        self.assertEqual(token_cache.revisions.epoch(), epoch)
+
+    def test_sparse_fieldsets(self):
+        """ Параметр fields= ограничивает поля в ответе. """
+
+        ids = []
+        token = None
+        for i in range(0, 3):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            token = user.get_token()
+            ids.append(user.id)
+        headers = {'Authorization': f"Bearer {token}"}
+
+        # invalid request
+        for url in [f'/api/users/{ids[2]}?fields=password_hash', '/api/users?fields=email',
+                    '/api/users?fields=,', f'/api/users?ids={ids[0]}&fields=token']:
+            resp = self.app.get(url, headers=headers)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+
+        resp = self.app.get(f'/api/users/{ids[2]}?fields=email,username', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual(resp.json, {'email': 'user2@gg.com', 'username': 'user2'})
+
+        resp = self.app.get('/api/users?fields=username&limit=2', headers=headers)
+        self.assertEqual(resp.json['items'], [{'username': 'user0'}, {'username': 'user1'}])
+        resp = self.app.get(resp.json['_links']['next'], headers=headers)
+        self.assertEqual(resp.json['items'], [{'username': 'user2'}])
+
+        resp = self.app.get('/api/users?fields=id&stream=1', headers=headers)
+        self.assertEqual(resp.json['items'], [{'id': id} for id in ids])
+
+        resp = self.app.get(f'/api/users?ids={ids[2]}&fields=id,email', headers=headers)
+        self.assertEqual(resp.json['items'], [{'id': ids[2], 'email': 'user2@gg.com'}])
+
+    def test_users_changes(self):
+        """ Лента изменений пользователей по курсору since. """
+
+        ids = []
+        tokens = []
+        for i in range(0, 3):
+            user = self.create_user(data={
+                'username': f'user{i}',
+                'password': f'user{i}',
+                'email': f'user{i}@gg.com'
+            })
+            tokens.append(user.get_token())
+            ids.append(user.id)
+        headers = {'Authorization': f"Bearer {tokens[1]}"}
+
+        # invalid request
+        for query in ['since=-1', 'since=abc', 'limit=0']:
+            resp = self.app.get(f'/api/users/changes?{query}', headers=headers)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+
+        resp = self.app.get('/api/users/changes?limit=2', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual([item['id'] for item in resp.json['items']], ids[:2])
+        self.assertTrue(resp.json['_meta']['has_more'])
+        self.assertIsNotNone(resp.json['items'][0]['created_at'])
+
+        resp = self.app.get(f'/api/users/changes?since={resp.json["_meta"]["next_cursor"]}', headers=headers)
+        self.assertEqual([item['id'] for item in resp.json['items']], ids[2:])
+        self.assertFalse(resp.json['_meta']['has_more'])
+        cursor = resp.json['_meta']['next_cursor']
+
+        # отзыв токена не виден в API и не попадает в ленту
+        User.get_by_id(ids[0]).revoke_token()
+        resp = self.app.get(f'/api/users/changes?since={cursor}', headers=headers)
+        self.assertEqual(resp.json['items'], [])
+        self.assertEqual(resp.json['_meta']['next_cursor'], cursor)
+
+        self.app.put(f'/api/users/{ids[1]}', headers=headers, json={'username': 'renamed'})
+        resp = self.app.get(f'/api/users/changes?since={cursor}', headers=headers)
+        self.assertEqual([item['username'] for item in resp.json['items']], ['renamed'])
+        self.assertGreater(resp.json['_meta']['next_cursor'], cursor)
+
+    def test_post_fork(self):
+        """ Подготовка воркера после fork: новые база, лог и пул хэширования, пустые кэши. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        self.app.get(f'/api/users/{user.id}', headers=headers)
+        self.assertEqual(token_cache.stats()['size'], 1)
+
+        listener = app.extensions['log_listener']
+        database = app.extensions['database']
+        hasher = app.extensions['password_hasher']
+        post_fork(app, worker_id=1)
+        listener.stop()
+
+        self.assertIsNot(app.extensions['log_listener'], listener, 'Log listener not restarted.')
+        self.assertIsNot(app.extensions['database'], database, 'Database not reinitialized.')
+        self.assertIsNot(app.extensions['password_hasher'], hasher, 'Hashing pool not reset.')
+        self.assertIsNone(app.extensions['token_sweeper'], 'Sweeper started outside worker 0.')
+        self.assertEqual(token_cache.stats()['size'], 0)
+
+        resp = self.app.get(f'/api/users/{user.id}', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+
+    def test_app_factory(self):
+        """ Настройки по умолчанию, независимые приложения, очистка токенов только при обслуживании запросов. """
+
+        class BaselineConfig(object):  # config.py без новых настроек
+            SECRET_KEY = 'secret_key'
+            SECURITY_PASSWORD_SALT = 'password_salt'
+            DATABASE_PATH = os.path.join(test_dir.name, 'other.db')
+            LOG_FILE = os.path.join(test_dir.name, 'other.log')
+            TOKEN_CACHE_SIZE = 1
+            METRICS_ENABLED = True
+
+        other = create_app(BaselineConfig)
+        try:
+            self.assertEqual(other.config['USERS_PER_PAGE'], 100)
+            self.assertNotIn('token_sweeper', other.extensions, 'Sweeper started by create_app.')
+
+            with other.app_context():
+                self.assertIs(db.obj, other.extensions['database'])
+                self.assertEqual(current_token_cache.maxsize, 1)
+            with app.app_context():
+                self.assertIs(db.obj, app.extensions['database'])
+                self.assertIs(current_token_cache._get_current_object(), token_cache)
+            self.assertTrue(other.extensions['metrics'].enabled)
+            self.assertFalse(metrics.enabled)
+
+            other.test_client().get('/api/metrics')
+            sweeper = other.extensions['token_sweeper']
+            self.assertTrue(sweeper.is_alive(), 'Sweeper not started by first request.')
+            sweeper.stop()
+        finally:
+            listener = other.extensions['log_listener']
+            atexit.unregister(listener.stop)
+            listener.stop()
+
+    def test_read_routing(self):
+        """ SELECT через соединения только для чтения, после записи - через писателя. """
+
+        with tempfile.TemporaryDirectory() as tmp:
+            database = RoutedSqliteDatabase(os.path.join(tmp, 'routing.db'), read_connections=1,
+                                            pragmas=TestConfig.DATABASE_PRAGMAS)
+            with database.bind_ctx(MODELS, bind_refs=False, bind_backrefs=False):
+                database.create_tables(MODELS)
+                user = self.create_user()
+                database.close()
+
+                self.assertEqual(User.get_by_id(user.id).username, 'test')
+                reader = database._route.reader
+                self.assertIsNotNone(reader, 'Select not routed to reader.')
+                with self.assertRaises(sqlite3.OperationalError):
+                    reader.execute('DELETE FROM "user"')
+
+                # запрос видит свои изменения
+                User.update(username='new').where(User.id == user.id).execute()
+                with database.atomic():
+                    self.assertEqual(User.get_by_id(user.id).username, 'new')
+                self.assertEqual(User.get_by_id(user.id).username, 'new')
+
+                database.close()
+                self.assertIsNone(database._route.reader)
+                self.assertEqual(database._readers.qsize(), 1, 'Reader not returned to pool.')
+                self.assertEqual(User.get_by_id(user.id).username, 'new')
+                self.assertIs(database._route.reader, reader)
+                database.close()
+                database.close_readers()
+
+    def test_search_users(self):
+        """ Поиск пользователей по началу username или по email целиком. """
+
+        ids = {}
+        for username, email in [('john', 'john.doe@gg.com'), ('johnny', 'jj@gg.com'),
+                                ('ann', 'ann@john.com'), ('John_Smith', 'smith@gg.com')]:
+            user = self.create_user(data={'username': username, 'password': username, 'email': email})
+            ids[username] = user.id
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+
+        # invalid request
+        for query in ['', 'q=', 'q=j', 'q=john&limit=0', 'q=john&offset=-1', 'q=john&fields=email']:
+            resp = self.app.get(f'/api/users/search?{query}', headers=headers)
+            self.assertEqual(resp.status_code, 400, f'status_code == {resp.status_code}')
+            self.assertEqual(resp.json['code'], 1010, f'code == {resp.json["code"]}')
+
+        resp = self.app.get('/api/users/search?q=john', headers=headers)
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertEqual([item['username'] for item in resp.json['items']], ['john', 'johnny', 'John_Smith'])
+
+        resp = self.app.get('/api/users/search?q=jj@gg.com&fields=id', headers=headers)
+        self.assertEqual(resp.json['items'], [{'id': ids['johnny']}])
+        # по началу чужого email не ищется
+        resp = self.app.get('/api/users/search?q=jj@', headers=headers)
+        self.assertEqual(resp.json['items'], [])
+
+        # постраничная выдача по ссылке next
+        usernames = []
+        url = '/api/users/search?q=joh&limit=2'
+        while url:
+            resp = self.app.get(url, headers=headers)
+            usernames += [item['username'] for item in resp.json['items']]
+            url = resp.json['_links']['next']
+        self.assertEqual(usernames, ['john', 'johnny', 'John_Smith'])
+
+        # индекс обновляется триггерами
+        User.update(username='bob').where(User.id == ids['johnny']).execute()
+        User.delete().where(User.id == ids['john']).execute()
+        response_cache.clear()  # изменения в обход API не инвалидируют кэш ответов
+        resp = self.app.get('/api/users/search?q=john', headers=headers)
+        self.assertEqual([item['username'] for item in resp.json['items']], ['John_Smith'])
+
+        # без FTS5 - диапазонные запросы по индексам
+        test_db.execute_sql('DROP TABLE user_search')
+        data = User.search('bo', 10)
+        self.assertEqual([item['username'] for item in data['items']], ['bob'])
+        data = User.search('ann@', 10)
+        self.assertEqual(data['items'], [])
+        data = User.search('ann@john.com', 10)
+        self.assertEqual([item['id'] for item in data['items']], [ids['ann']])
+
+    def test_sessions(self):
+        """ Несколько сессий пользователя и закрытие одной из них. """
+
+        user = self.create_user()
+        tokens = [user.get_token(), user.get_token()]
+        self.assertNotEqual(tokens[0], tokens[1])
+        self.assertFalse(Session.select().where(Session.token_hash.in_(tokens)).exists(), 'Raw token stored.')
+
+        for token in tokens:
+            resp = self.app.get(f'/api/users/{user.id}', headers={'Authorization': f"Bearer {token}"})
+            self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+
+        resp = self.app.delete('/api/tokens', headers={'Authorization': f"Bearer {tokens[0]}"})
+        self.assertEqual(resp.status_code, 204, f'status_code == {resp.status_code}')
+        self.assertIsNone(User.check_token(tokens[0]))
+        self.assertEqual(User.check_token(tokens[1]), user, 'Other session closed.')
+
+        user.revoke_token()
+        self.assertIsNone(User.check_token(tokens[1]))
+
+    def test_dirty_only_writes(self):
+        """ UPDATE пишет только измененные поля, без изменений запись пропускается. """
+
+        user = self.create_user()
+        headers = {'Authorization': f"Bearer {user.get_token()}"}
+        url = f'/api/users/{user.id}'
+
+        with self.assertLogs('peewee', 'DEBUG') as logs:
+            resp = self.app.put(url, headers=headers, json={'username': 'test', 'email': 'test@gg.com'})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        self.assertFalse([record for record in logs.output if 'UPDATE' in record], 'Unchanged user written.')
+
+        with self.assertLogs('peewee', 'DEBUG') as logs:
+            self.app.put(url, headers=headers, json={'username': 'new', 'email': 'test@gg.com',
+                                                     'birthday': '2000-09-20'})
+        updates = [record for record in logs.output if 'UPDATE "user"' in record]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"username"', updates[0])
+        self.assertNotIn('"email"', updates[0])
+        self.assertNotIn('"password_hash"', updates[0])
+
+        user = User.get_by_id(user.id)
+        self.assertEqual((user.username, str(user.birthday)), ('new', '2000-09-20'))
+        self.assertFalse(user.save(), 'Clean user written.')
+
+    def test_batch(self):
+        """ Пакет подзапросов: общий токен, ответы по порядку, коды ошибок, откат ошибочных. """
+
+        user = self.create_user()
+        other = self.create_user({'username': 'other', 'password': 'test', 'email': 'other@gg.com'})
+        token = user.get_token()
+        headers = {'Authorization': f"Bearer {token}"}
+        with self.assertLogs(app.logger, 'INFO') as logs:
+            resp = self.app.post('/api/batch', headers=headers, json={'requests': [
+                {'method': 'GET', 'path': f'/users/{user.id}'},
+                {'method': 'PUT', 'path': f'/users/{user.id}', 'body': {'username': 'new'}},
+                {'method': 'PUT', 'path': f'/users/{other.id}', 'body': {'username': 'hacked'}},
+                {'method': 'GET', 'path': f'/users/{user.id}?fields=username'},
+                {'method': 'GET', 'path': '/batch'},
+                {'method': 'DELETE', 'path': '/tokens'},
+                {'method': 'GET', 'path': f'/users/{user.id}',
+                 'headers': {'Authorization': f'Bearer {token}'}}
+            ]})
+        self.assertEqual(resp.status_code, 200, f'status_code == {resp.status_code}')
+        responses = resp.get_json()['responses']
+        self.assertEqual([r['status'] for r in responses], [200, 200, 400, 200, 404, 204, 400])
+        self.assertEqual(responses[0]['body']['username'], 'test')
+        self.assertEqual(responses[2]['body']['code'], apiErr.RightsError().api_code)
+        self.assertEqual(responses[3]['body'], {'username': 'new'})
+        self.assertEqual(responses[4]['body']['code'], apiErr.NotFoundError().api_code)
+        self.assertIsNone(responses[5]['body'])
+        self.assertEqual(responses[6]['body']['code'], apiErr.InvalidTokenError().api_code)
+        self.assertEqual(User.get_by_id(other.id).username, 'other')
+        self.assertEqual(User.get_by_id(user.id).username, 'new')
+
+        # в лог пакета попадают только методы и пути подзапросов, без заголовков и тел
+        self.assertEqual(len(logs.records), 1, 'Not one record per batch.')
+        record = logs.records[0].msg
+        self.assertEqual(record['requests'][1], f'PUT /users/{user.id}')
+        self.assertEqual(len(record['requests']), 7)
+        self.assertNotIn('request', record)
+        self.assertNotIn(token, str(record))
+
+        resp = self.app.post('/api/batch', json={'requests': []})
+        self.assertEqual(resp.get_json()['code'], apiErr.InsufficientDataError().api_code)
+        resp = self.app.post('/api/batch', json={'requests': [{'method': 'PATCH', 'path': '/users'}]})
+        self.assertEqual(resp.get_json()['code'], apiErr.InvalidParamsError().api_code)
+        resp = self.app.post('/api/batch', json={'requests': [{'method': 'GET', 'path': '/users'}] *
+                                                 (app.config['BATCH_MAX_REQUESTS'] + 1)})
+        self.assertEqual(resp.get_json()['code'], apiErr.InvalidParamsError().api_code)
+
 
 if __name__ == '__main__':
     unittest.main()